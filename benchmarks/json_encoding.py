@@ -0,0 +1,93 @@
+"""
+In this module, the encoding of large product listings to response bodies is
+benchmarked. The listing is fetched page by page from the product collection
+and merged into one document, which is then encoded as the resources did
+before, with json.dumps and encoding the string to UTF-8, and with every
+encoder of productsapi.encoding. For every encoder the time per listing and
+the size of the body are printed.
+
+    python benchmarks/json_encoding.py --products 2000 --rounds 50
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from productsapi import create_app, db
+from productsapi.api import MAX_PAGE_SIZE
+from productsapi.db import User, Product
+from productsapi.encoding import ENCODERS
+
+
+def populate(app, products):
+    """
+    This function creates the db with a seller and the products.
+    """
+    with app.app_context():
+        db.create_all()
+        seller = User(name="seller", email="seller@example.com",
+                      password="password", role="Seller")
+        db.session.add(seller)
+        for index in range(products):
+            db.session.add(Product(
+                name=f"product{index}", price=1 + index % 100, description="Tuote ä " * 40,
+                images=json.dumps([f"https://example.com/images/{index}/{n}.png" for n in range(3)]),
+                user=seller))
+        db.session.commit()
+
+
+def fetch_listing(app):
+    """
+    This function fetches all pages of the product collection and returns
+    the first page with the products of all pages.
+    """
+    with app.test_client() as client:
+        url = f"/api/users/products/?limit={MAX_PAGE_SIZE}"
+        listing = None
+        while url:
+            page = client.get(url).get_json()
+            if listing is None:
+                listing = page
+            else:
+                listing["items"].extend(page["items"])
+            url = page["@controls"].get("next", {}).get("href")
+    return listing
+
+
+def measure(encode, document, rounds):
+    """
+    This function returns the mean seconds per encoding and the body.
+    """
+    body = encode(document)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        encode(document)
+    return (time.perf_counter() - start) / rounds, body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(directory, "benchmark.db"),
+        })
+        populate(app, args.products)
+        listing = fetch_listing(app)
+    encoders = {"json.dumps (before)": lambda document: json.dumps(document).encode()}
+    encoders.update(ENCODERS)
+    print(f"{len(listing['items'])} products, {args.rounds} rounds per encoder")
+    print(f"{'encoder':<22}{'ms/listing':>12}{'bytes':>12}")
+    for name, encode in encoders.items():
+        seconds, body = measure(encode, listing, args.rounds)
+        print(f"{name:<22}{seconds * 1000:>12.2f}{len(body):>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+In this module, concurrent reads and writes against the SQLite db are
+benchmarked with the default and the production SQLITE_PROFILE. Readers
+list pages of products while writers add and delete reviews, each in its
+own process like the workers of a server. For every profile the reads and
+writes per second and the operations failing with "database is locked"
+are printed.
+
+    python benchmarks/sqlite_concurrency.py --readers 4 --writers 2 --seconds 5
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy.exc import OperationalError
+from productsapi import create_app, db
+from productsapi.db import User, Product, Review
+
+PRODUCTS = 500
+
+
+def make_app(path, profile):
+    """
+    This function creates an app using the db at path with the profile.
+    """
+    return create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + path,
+        "SQLITE_PROFILE": profile,
+    })
+
+
+def populate(path, profile, writers):
+    """
+    This function creates the db with one user per writer and the products.
+    """
+    app = make_app(path, profile)
+    with app.app_context():
+        db.create_all()
+        for index in range(writers + 1):
+            db.session.add(User(name=f"user{index}", email=f"user{index}@example.com",
+                                password="password", role="Customer"))
+        db.session.flush()
+        seller = User.query.filter_by(name="user0").first()
+        for index in range(PRODUCTS):
+            db.session.add(Product(name=f"product{index}", price=1 + index % 100,
+                                   description="x" * 500, user=seller))
+        db.session.commit()
+
+
+def read(index):
+    """
+    This function lists one page of products, as the product collection does.
+    """
+    after = index * 50 % PRODUCTS
+    Product.query.filter(Product.id > after).order_by(Product.id).limit(50).all()
+    db.session.commit()
+
+
+def write(index, user_id):
+    """
+    This function adds a review and deletes it, with their rating aggregates.
+    """
+    product_id = index % PRODUCTS + 1
+    review = Review(rating=5, user_id=user_id, product_id=product_id)
+    db.session.add(review)
+    Product.add_rating(product_id, 5)
+    db.session.commit()
+    db.session.delete(review)
+    Product.add_rating(product_id, 5, -1)
+    db.session.commit()
+
+
+def worker(path, profile, role, number, seconds, results):
+    """
+    This function runs reads or writes until the time is up and reports the
+    number of successful and locked operations.
+    """
+    app = make_app(path, profile)
+    done = locked = 0
+    with app.app_context():
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            try:
+                if role == "read":
+                    read(done)
+                else:
+                    write(done, number + 2)
+                done += 1
+            except OperationalError as exc:
+                db.session.rollback()
+                if "locked" not in str(exc):
+                    raise
+                locked += 1
+    results.put((role, done, locked))
+
+
+def run(profile, readers, writers, seconds):
+    """
+    This function runs the readers and writers against a new db and returns
+    the reads and writes per second and the locked operations.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "benchmark.db")
+        populate(path, profile, writers)
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=worker, args=(path, profile, role, number, seconds, results))
+            for role, count in (("read", readers), ("write", writers))
+            for number in range(count)
+        ]
+        for process in processes:
+            process.start()
+        totals = {"read": 0, "write": 0, "locked": 0}
+        for _ in processes:
+            role, done, locked = results.get()
+            totals[role] += done
+            totals["locked"] += locked
+        for process in processes:
+            process.join()
+    return totals["read"] / seconds, totals["write"] / seconds, totals["locked"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+    print(f"{args.readers} readers, {args.writers} writers, {args.seconds} s per profile")
+    print(f"{'profile':<12}{'reads/s':>10}{'writes/s':>10}{'locked':>8}")
+    for profile in ("default", "production"):
+        reads, writes, locked = run(profile, args.readers, args.writers, args.seconds)
+        print(f"{profile:<12}{reads:>10.0f}{writes:>10.0f}{locked:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,19 @@
 """
-In this module, the sqlite foreign keys are set, app and cache are initiated and configured.
-Also, the converters are set.
+In this module, the sqlite foreign keys and pragmas are set, app and cache are initiated and configured.
+Also, the converters are set. The cache backend is chosen with the CACHE_* config.
 """
 import os
 from flask import Flask
 from flask_cors import CORS
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
-from productsapi.db import db
-from productsapi.api import api, cache
-from productsapi.converters import UserConverter, CategoryConverter
+from productsapi.db import db, init_blacklist_index, init_token_cache, rebuild_ratings_command, \
+    upgrade_db_command
+from productsapi.api import api, cache, init_url_templates, init_control_blocks
+from productsapi.caching import init_response_cache
+from productsapi.converters import UserConverter, CategoryConverter, init_name_keys
+from productsapi.encoding import init_json_encoder
+from productsapi.instrumentation import init_query_stats
 
 # Setup the sqlite db to use foreign keys
 
@@ -22,6 +26,40 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor.execute("PRAGMA foreign_keys=ON")
     cursor.close()
 
+# Pragmas set on every new SQLite connection, by SQLITE_PROFILE. The
+# production profile lets readers run alongside a writer (WAL), syncs only
+# at checkpoints, waits for locks instead of failing at once and keeps more
+# of the db in memory.
+SQLITE_PROFILES = {
+    "default": {},
+    "production": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,
+        "temp_store": "MEMORY",
+    },
+}
+
+
+def init_sqlite_profile(app, engine):
+    """
+    In this function, the pragmas of the SQLITE_PROFILE, with the overrides
+    in SQLITE_PRAGMAS, are set on every new connection of the engine.
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    pragmas = {**SQLITE_PROFILES[app.config["SQLITE_PROFILE"]],
+               **app.config["SQLITE_PRAGMAS"]}
+
+    @event.listens_for(engine, "connect")
+    def set_profile_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
 # Based on http://flask.pocoo.org/docs/1.0/tutorial/factory/#the-application-factory
 # Modified to use Flask SQLAlchemy
 def create_app(test_config=None):
@@ -32,7 +70,40 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY="dev",
         SQLALCHEMY_DATABASE_URI="sqlite:///test.db",
-        SQLALCHEMY_TRACK_MODIFICATIONS=False
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        # "default" keeps the SQLite defaults, SQLITE_PRAGMAS overrides
+        # single pragmas of the profile
+        SQLITE_PROFILE="production",
+        SQLITE_PRAGMAS={},
+        QUERY_STATS_ENABLED=False,
+        QUERY_REPEAT_THRESHOLD=5,
+        BLACKLIST_SYNC_INTERVAL=5,
+        BLACKLIST_PRUNE_INTERVAL=3600,
+        TOKEN_CACHE_SIZE=1024,
+        # Names of users and categories in URLs resolved to primary keys,
+        # unknown names are remembered for a shorter time
+        NAME_KEY_CACHE_SIZE=4096,
+        NAME_KEY_CACHE_TTL=60,
+        NAME_KEY_NEGATIVE_TTL=5,
+        # Use "productsapi.cache_backends.SQLiteCache" to share one cache
+        # between all the worker processes on a host
+        CACHE_TYPE="SimpleCache",
+        # Writes invalidate the entries depending on them, so entries can
+        # live for hours. The tag index counts towards the threshold.
+        CACHE_DEFAULT_TIMEOUT=6 * 3600,
+        CACHE_THRESHOLD=2000,
+        CACHE_REBUILD_TIMEOUT=5,
+        # Serve stale collections for up to CACHE_MAX_STALENESS seconds
+        # after a write while they are rebuilt in the background
+        CACHE_STALE_WHILE_REVALIDATE=False,
+        CACHE_MAX_STALENESS=30,
+        # "inline" embeds the schemas in the controls, "url" references the
+        # ones served at /schemas/<entity>/ by schemaUrl
+        SCHEMA_MODE="inline",
+        SCHEMA_MAX_AGE=24 * 3600,
+        # "auto" encodes the response bodies with orjson when it is
+        # installed, "json" with the standard library
+        JSON_ENCODER="auto"
     )
     if test_config is None:
         app.config.from_pyfile("config.py", silent=True)
@@ -44,14 +115,26 @@ def create_app(test_config=None):
         pass
     CORS(app)
     db.init_app(app)
+    with app.app_context():
+        init_sqlite_profile(app, db.engine)
+        init_query_stats(app, db.engine)
+    init_blacklist_index(app)
+    init_token_cache(app)
+    app.cli.add_command(rebuild_ratings_command)
+    app.cli.add_command(upgrade_db_command)
     # Map converters
+    init_json_encoder(app)
+    init_name_keys(app)
     app.url_map.converters['user'] = UserConverter
     app.url_map.converters['category'] = CategoryConverter
 
     # Init api
     api.init_app(app)
+    init_url_templates(app)
+    init_control_blocks(app)
 
     # Init cache
     cache.init_app(app)
+    init_response_cache(app)
     return app
 
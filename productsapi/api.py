@@ -1,17 +1,39 @@
 import json
-from flask import Response, request, make_response, jsonify, url_for
+import re
+from urllib.parse import urlencode, urlsplit, parse_qsl, quote
+from flask import Response, request, make_response, jsonify, url_for, current_app
 from flask_restful import Api, Resource
 from sqlalchemy.exc import IntegrityError
-from werkzeug.exceptions import Conflict, BadRequest, UnsupportedMediaType
-from jsonschema import validate, ValidationError
-from flask_caching import Cache
+from sqlalchemy.orm.exc import ObjectDeletedError
+from werkzeug.exceptions import Conflict, BadRequest, NotFound, UnsupportedMediaType
+from jsonschema import ValidationError
+from jsonschema.validators import validator_for
 from validate_email import validate_email
-from productsapi.db import db, User, Product, Review, Category, BlacklistToken
+from productsapi.db import db, User, Product, Review, Category, BlacklistToken, only_fields
+from productsapi.caching import cache, cached_response, cache_response, invalidate, patch_entry, \
+    representation_args
 #from werkzeug.routing import BaseConverter
 #from productsapi.converters import UserConverter
-api = Api()
+from productsapi.converters import forget_names, forget_all_names
+from productsapi.encoding import dumps, dumps_default
 
-cache = Cache(config={'CACHE_TYPE': 'simple', "CACHE_DEFAULT_TIMEOUT": 300})
+
+class CommerceApi(Api):
+    """
+    This class answers requests for rows deleted by another worker after the
+    URL converters cached their names with 404, see converters.resolve.
+    Flask-RESTful turns errors of its resources into a 500 before the error
+    handlers of the app are reached, so this is done here.
+    """
+
+    def handle_error(self, e):
+        if isinstance(e, ObjectDeletedError):
+            forget_all_names()
+            e = NotFound()
+        return super().handle_error(e)
+
+
+api = CommerceApi()
 
 MASON = "application/vnd.mason+json"
 ERROR_PROFILE = "/profiles/error/"
@@ -22,9 +44,38 @@ PRODUCT_PROFILE_URL = "/profiles/product/"
 CATEGORY_PROFILE_URL = "/profiles/category/"
 REVIEW_PROFILE_URL = "/profiles/review/"
 
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
 # HELPER FUNCTIONS
 
 
+def compile_validator(schema):
+    """
+    Checks the schema against its meta-schema once and returns a reusable
+    validator for it. Formats such as email are checked as well.
+    """
+    validator_class = validator_for(schema)
+    validator_class.check_schema(schema)
+    return validator_class(schema, format_checker=validator_class.FORMAT_CHECKER)
+
+
+# The JSON schemas of the entities, embedded in the controls of responses
+# or served at /schemas/<entity>/
+SCHEMAS = {
+    "user": User.json_schema(),
+    "product": Product.json_schema(),
+    "review": Review.json_schema(),
+    "category": Category.json_schema(),
+}
+SCHEMA_BODIES = {entity: dumps_default(schema) for entity, schema in SCHEMAS.items()}
+
+USER_VALIDATOR = compile_validator(SCHEMAS["user"])
+PRODUCT_VALIDATOR = compile_validator(SCHEMAS["product"])
+REVIEW_VALIDATOR = compile_validator(SCHEMAS["review"])
+CATEGORY_VALIDATOR = compile_validator(SCHEMAS["category"])
+
+
 def authorize_user(auth_header):
     if auth_header:
         try:
@@ -40,11 +91,11 @@ def authorize_user(auth_header):
     else:
         auth_token = ''
     if auth_token:
-        resp = User.decode_auth_token(auth_token)
-        if 'token blacklisted' in resp.lower() or 'signature expired' in resp.lower() or 'invalid token' in resp.lower():
+        _, error = User.verify_auth_token(auth_token)
+        if error:
             response_object = {
                 'status': 'fail',
-                'message': resp
+                'message': error
             }
             response = jsonify(response_object)
             response.status_code = 401
@@ -60,6 +111,561 @@ def authorize_user(auth_header):
     return response
 
 
+def parse_page_args(args=None):
+    """
+    Reads the keyset pagination parameters from the query string, or from
+    the given args. Returns a tuple of (limit, after), where after is the id
+    of the last item of the previous page or None when the first page is
+    requested.
+    """
+    if args is None:
+        args = request.args
+    try:
+        limit = int(args.get("limit", DEFAULT_PAGE_SIZE))
+        after = args.get("after")
+        if after is not None:
+            after = int(after)
+    except ValueError as exc:
+        raise BadRequest(description="limit and after must be integers") from exc
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise BadRequest(
+            description=f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    return limit, after
+
+
+def page_href(limit, after=None):
+    """
+    Builds the href of a collection page for the current request path.
+    The other parameters selecting the representation, e.g. fields or sort,
+    are kept in the canonical order of the cache keys, unknown ones are
+    dropped.
+    """
+    args = {name: value for name, value in representation_args(request.args)
+            if name not in ("limit", "after")}
+    args["limit"] = limit
+    if after is not None:
+        args["after"] = after
+    return request.path + "?" + urlencode(representation_args(args))
+
+
+# Placeholders of the URL rules, e.g. <user:user> or <product>
+URL_PLACEHOLDER = re.compile(r"<(?:[^<>:]+:)?([^<>:]+)>")
+# Characters Werkzeug's converters leave unquoted in URL values
+URL_SAFE = "/:!$'()*+,;"
+URL_UNSAFE = re.compile(r"[^A-Za-z0-9\-._~/:!$'()*+,;]")
+
+
+def init_url_templates(app):
+    """
+    This function compiles the URL rules of the app into format strings,
+    keyed by endpoint and argument names, once all the resources are
+    routed. The first rule of an endpoint wins, as with url_for. Every app
+    routes the same resources, so the templates are kept on
+    CommerceMetaBuilder.
+    """
+    templates = {}
+    for rule in app.url_map.iter_rules():
+        template = URL_PLACEHOLDER.sub(r"{\1}", rule.rule)
+        templates.setdefault((rule.endpoint, frozenset(rule.arguments)), template)
+    CommerceMetaBuilder.url_templates = templates
+
+
+def build_href(endpoint, **values):
+    """
+    Builds the URL of an endpoint like url_for, but by formatting its
+    precompiled template, see init_url_templates. Values are percent-encoded
+    like Werkzeug does, users and categories are given by their names.
+    """
+    template = CommerceMetaBuilder.url_templates.get((endpoint, frozenset(values)))
+    if template is None:
+        return url_for(endpoint, **values)
+    for name, value in values.items():
+        if not isinstance(value, str):
+            value = str(getattr(value, "name", value))
+        # Most names need no quoting
+        values[name] = quote(value, safe=URL_SAFE) if URL_UNSAFE.search(value) else value
+    return request.root_path + template.format_map(values)
+
+
+# The entities with their collection endpoints, in the order of the controls
+ENTITY_COLLECTIONS = {
+    "user": "users", "product": "products", "category": "categories", "review": "reviews",
+}
+
+
+def init_control_blocks(app):
+    """
+    This function attaches the store of the controls built by
+    control_blocks to the app.
+    """
+    app.extensions["control_blocks"] = {}
+
+
+def control_blocks():
+    """
+    Returns the controls that are the same in every response, built once
+    per app and mount point and shared by all responses. The edit controls,
+    keyed by "edit:<entity>", lack the href of the item. With SCHEMA_MODE
+    "url" the controls reference the schemas served at /schemas/<entity>/
+    by schemaUrl instead of embedding them.
+    """
+    blocks_by_root = current_app.extensions["control_blocks"]
+    blocks = blocks_by_root.get(request.root_path)
+    if blocks is not None:
+        return blocks
+    by_url = current_app.config["SCHEMA_MODE"] == "url"
+    blocks = {}
+    for entity, collection in ENTITY_COLLECTIONS.items():
+        schema = {"schemaUrl": build_href("schema", entity=entity)} if by_url else \
+            {"schema": SCHEMAS[entity]}
+        blocks[f"commercemeta:{collection}-all"] = {
+            "title": "all " + collection, "href": build_href(collection)}
+        blocks["commercemeta:add-" + entity] = {
+            "method": "POST", "encoding": "json", "title": "add new " + entity,
+            **schema, "href": build_href(collection)}
+        blocks["edit:" + entity] = {
+            "method": "PUT", "encoding": "json", "title": "edit", **schema}
+    blocks_by_root[request.root_path] = blocks
+    return blocks
+
+
+# The columns product listings can be sorted by
+PRODUCT_SORTS = {
+    "id": Product.id,
+    "price": Product.price,
+    "name": Product.name,
+    "rating": Product.rating_average,
+}
+
+
+def parse_listing_args(args=None):
+    """
+    Reads the filtering and sorting parameters of product listings from the
+    query string, or from the given args. Returns a tuple of (min_price,
+    max_price, sort, descending), where the prices are None when not given.
+    """
+    if args is None:
+        args = request.args
+    try:
+        min_price = float(args["min_price"]) if "min_price" in args else None
+        max_price = float(args["max_price"]) if "max_price" in args else None
+    except ValueError as exc:
+        raise BadRequest(description="min_price and max_price must be numbers") from exc
+    sort = args.get("sort", "id")
+    if sort not in PRODUCT_SORTS:
+        raise BadRequest(description="sort must be one of " + ", ".join(PRODUCT_SORTS))
+    order = args.get("order", "asc")
+    if order not in ("asc", "desc"):
+        raise BadRequest(description="order must be asc or desc")
+    return min_price, max_price, sort, order == "desc"
+
+
+def is_plain_listing(args):
+    """
+    Tells whether the args list all products by id, without filtering.
+    """
+    return parse_listing_args(args) == (None, None, "id", False)
+
+
+def filter_products(query, listing):
+    """
+    Applies the price range of the listing to a query of products.
+    """
+    min_price, max_price, _, _ = listing
+    if min_price is not None:
+        query = query.filter(Product.price >= min_price)
+    if max_price is not None:
+        query = query.filter(Product.price <= max_price)
+    return query
+
+
+def sort_keys(listing):
+    """
+    Returns the columns a listing is ordered by. The id breaks ties, so that
+    every product has a unique position for keyset pagination.
+    """
+    sort = listing[2]
+    if sort == "id":
+        return [Product.id]
+    return [PRODUCT_SORTS[sort], Product.id]
+
+
+def order_products(query, listing, reverse=False):
+    """
+    Orders a query of products as the listing, or in the opposite order.
+    """
+    if listing[3] != reverse:
+        return query.order_by(*[key.desc() for key in sort_keys(listing)])
+    return query.order_by(*sort_keys(listing))
+
+
+def product_cursor(listing, after):
+    """
+    Returns the sort keys of the product with the id after, the last
+    product of the previous page. They are looked up, so that page links
+    only carry the id.
+    """
+    if listing[2] == "id":
+        return [after]
+    value = db.session.query(PRODUCT_SORTS[listing[2]]).filter(Product.id == after).scalar()
+    if value is None:
+        raise BadRequest(
+            description="The product after is no longer listed, start from the first page")
+    return [value, after]
+
+
+def after_cursor(query, listing, cursor, reverse=False):
+    """
+    Keeps the products after the cursor in the order of the listing, or
+    with reverse the products up to and including the cursor.
+    """
+    keys, values = db.tuple_(*sort_keys(listing)), db.tuple_(*cursor)
+    descending = listing[3]
+    if reverse:
+        return query.filter(keys >= values if descending else keys <= values)
+    return query.filter(keys < values if descending else keys > values)
+
+
+def page_products(data, query, ids, listing):
+    """
+    Returns the requested page of a query of products in the order of the
+    listing and adds the next and prev controls of the page to data. ids
+    queries the ids of the same products, the previous page is found with
+    it.
+    """
+    limit, after = parse_page_args()
+    query = order_products(query, listing)
+    if after is not None:
+        cursor = product_cursor(listing, after)
+        query = after_cursor(query, listing, cursor)
+    # Fetch one extra row to find out whether there is a next page
+    products = query.limit(limit + 1).all()
+    if len(products) > limit:
+        products = products[:limit]
+        data.add_control("next", href=page_href(limit, products[-1].id))
+    if after is not None:
+        # The previous page ends at the cursor, its own cursor is the id
+        # right before its first item
+        previous_ids = after_cursor(order_products(ids, listing, reverse=True),
+                                    listing, cursor, reverse=True).limit(limit + 1).all()
+        if len(previous_ids) > limit:
+            data.add_control("prev", href=page_href(limit, previous_ids[-1][0]))
+        elif previous_ids:
+            data.add_control("prev", href=page_href(limit))
+    return products
+
+
+class Fieldset:
+    """
+    This class describes the fields of the items of a resource for sparse
+    fieldsets, requested with ?fields= as a comma separated list of fields.
+    columns maps each field to the names of the model columns it is built
+    from, base are the columns the controls of an item are built from and
+    key is the field collection patches find items by, which is always
+    included.
+    """
+
+    def __init__(self, model, columns, base=(), key=None):
+        self.model = model
+        self.columns = columns
+        self.base = base
+        self.key = key
+
+    def requested(self, args=None):
+        """
+        Returns the set of requested fields, or None if all of them are
+        requested. Reads the current query string, or the given args.
+        """
+        if args is None:
+            args = request.args
+        if "fields" not in args:
+            return None
+        fields = {field for field in args["fields"].split(",") if field}
+        unknown = fields - set(self.columns)
+        if unknown:
+            raise BadRequest(description="Unknown fields: " + ", ".join(sorted(unknown)))
+        if self.key is not None:
+            fields.add(self.key)
+        return fields
+
+    def load(self, fields):
+        """
+        Returns the query options loading only the columns of the fields.
+        """
+        if fields is None:
+            return []
+        names = set(self.base)
+        for field in fields:
+            names.update(self.columns[field])
+        return [db.load_only(*[getattr(self.model, name) for name in sorted(names)])]
+
+
+USER_FIELDS = Fieldset(User, {
+    "name": ["name"], "password": ["password"], "email": ["email"],
+    "role": ["role"], "avatar": ["avatar"],
+}, base=["name"], key="name")
+PRODUCT_FIELDS = Fieldset(Product, {
+    "id": [], "name": [], "price": ["price"], "description": ["description"],
+    "images": ["images"], "user_name": [], "categories": [],
+    "review_summary": ["review_count", "rating_sum", "rating_sum_squares", "rating_histogram"],
+}, base=["name", "user_name"], key="id")
+REVIEW_FIELDS = Fieldset(Review, {
+    "id": [], "description": ["description"], "rating": ["rating"],
+    "user_name": [], "product_name": [],
+}, base=["user_name", "product_name"], key="id")
+CATEGORY_FIELDS = Fieldset(Category, {
+    "id": [], "name": [], "image": ["image"],
+}, base=["name"], key="id")
+
+# Items are serialized from rows already loaded, only the fields are checked
+USER_ITEM_FIELDS = Fieldset(User, dict.fromkeys(
+    ["id", "name", "password", "email", "role", "avatar", "products", "reviews"], []))
+PRODUCT_ITEM_FIELDS = Fieldset(Product, dict.fromkeys(
+    ["id", "name", "price", "description", "images", "categories", "reviews"], []))
+REVIEW_ITEM_FIELDS = Fieldset(Review, dict.fromkeys(
+    ["id", "description", "rating", "user", "product"], []))
+CATEGORY_ITEM_FIELDS = Fieldset(Category, dict.fromkeys(
+    ["id", "name", "image", "products"], []))
+
+
+def pick_fields(getters, fields):
+    """
+    Builds the requested fields of an item from functions returning their
+    values, so that the columns of other fields are never loaded.
+    """
+    return {field: getter() for field, getter in getters.items()
+            if fields is None or field in fields}
+
+
+def key_fields(key, fieldset):
+    """
+    Returns the fields of a cached representation from its key.
+    """
+    return fieldset.requested(dict(parse_qsl(urlsplit(key).query)))
+
+
+def user_item(user, fields=None):
+    """
+    Builds the item of a user in the user collection with the given fields.
+    """
+    item = CommerceMetaBuilder(pick_fields({
+        'name': lambda: user.name,
+        'password': lambda: user.password,
+        'email': lambda: user.email,
+        'role': lambda: user.role,
+        'avatar': lambda: user.avatar,
+    }, fields))
+    item.add_control("item", build_href("user", user=user))
+    return item
+
+
+def product_fields(product, fields=None):
+    """
+    Returns the given fields of a product in product listings. Instead of
+    the reviews, listings carry the rating summary of the product.
+    """
+    return pick_fields({
+        'id': lambda: product.id,
+        'name': lambda: product.name,
+        'price': lambda: product.price,
+        'description': lambda: product.description,
+        'images': lambda: json.loads(product.images) if product.images else None,
+        'user_name': lambda: product.user_name,
+        'review_summary': product.rating_summary,
+        'categories': lambda: [category.serialize(long=False) for category in product.categories],
+    }, fields)
+
+
+def product_item(product, fields=None):
+    """
+    Builds the item of a product in the product collection with the given
+    fields and a control to the full reviews of the product.
+    """
+    item = CommerceMetaBuilder(product_fields(product, fields))
+    item.add_control("item", build_href(
+        "product", product=product.name, username=product.user_name))
+    item.add_control_reviews_for(product.user_name, product.name)
+    item.add_control(
+        "commercemeta:products-by",
+        href=build_href("products_by_user", user=product.user_name)
+    )
+    if product.categories:
+        item.add_control(
+            "commercemeta:products-by",
+            href=build_href("products_by_category",
+                            category=product.categories[0].name)
+        )
+    return item
+
+
+def product_tags(product):
+    """
+    Returns the cache tags of a product item, see caching.py.
+    """
+    return ["product:"+str(product.id)] + \
+        ["category:"+str(category.id) for category in product.categories]
+
+
+def review_fields(review, fields=None):
+    """
+    Returns the given fields of a review in review listings.
+    """
+    return pick_fields({
+        'id': lambda: review.id,
+        'description': lambda: review.description,
+        'rating': lambda: review.rating,
+        'user_name': lambda: review.user_name,
+        'product_name': lambda: review.product_name,
+    }, fields)
+
+
+def review_item(review, fields=None):
+    """
+    Builds the item of a review in the review collection with the given
+    fields.
+    """
+    item = CommerceMetaBuilder(review_fields(review, fields))
+    item.add_control("item", build_href(
+        "review", product=review.product_name, username=review.user_name))
+    item.add_control(
+        "commercemeta:reviews-by",
+        href=build_href("reviews_by", user=review.user_name)
+    )
+    return item
+
+
+def find_review(username, product):
+    """
+    Returns the review of the product by the user, or None.
+    """
+    return Review.query.join(Review.user).join(Review.product).filter(
+        User.name == username, Product.name == product).first()
+
+
+def category_item(category, fields=None):
+    """
+    Builds the item of a category in the category collection with the given
+    fields.
+    """
+    item = CommerceMetaBuilder(pick_fields({
+        'id': lambda: category.id,
+        'name': lambda: category.name,
+        'image': lambda: category.image,
+    }, fields))
+    item.add_control("item", build_href(
+        "category", category=category))
+    return item
+
+
+# The patches below are applied to cached collections with patch_entry, see
+# caching.py. They return True when they change the document, False when it
+# is not affected and None when the change cannot be applied. Items are
+# given with all of their fields and cut down to the fields of each
+# representation.
+
+
+def append_item(item, fieldset):
+    """
+    Returns a patch adding the item to the end of a collection.
+    """
+    def patch(document, key):
+        document["items"].append(only_fields(item, key_fields(key, fieldset)))
+        return True
+    return patch
+
+
+def replace_item(item, fieldset, value):
+    """
+    Returns a patch replacing the item whose key field has the given value.
+    """
+    def patch(document, key):
+        for index, old_item in enumerate(document["items"]):
+            if old_item[fieldset.key] == value:
+                document["items"][index] = only_fields(item, key_fields(key, fieldset))
+                return True
+        return False
+    return patch
+
+
+def remove_item(fieldset, value):
+    """
+    Returns a patch removing the item whose key field has the given value.
+    """
+    def patch(document, key):
+        items = [item for item in document["items"] if item[fieldset.key] != value]
+        if len(items) == len(document["items"]):
+            return False
+        document["items"] = items
+        return True
+    return patch
+
+
+def append_product(product):
+    """
+    Returns a patch adding a new product to the page of the product
+    collection it belongs to. The new product has the largest id, so only
+    the last page changes, unless it is full and the product starts a new
+    page. Sorted or filtered pages are rebuilt instead.
+    """
+    def patch(document, key):
+        args = dict(parse_qsl(urlsplit(key).query))
+        if not is_plain_listing(args):
+            return None
+        limit, after = parse_page_args(args)
+        if "next" in document["@controls"] or (after is not None and after >= product.id):
+            return False
+        if len(document["items"]) >= limit:
+            return None
+        document["items"].append(only_fields(item, key_fields(key, PRODUCT_FIELDS)))
+        return True
+    item = product_item(product)
+    return patch
+
+
+def remove_product(product_id):
+    """
+    Returns a patch removing a deleted product from the pages of the product
+    collection. Pages after the product are not affected, unless their prev
+    control depends on it, and only the last page can lose an item without
+    taking one from the next page.
+    """
+    def patch(document, key):
+        args = dict(parse_qsl(urlsplit(key).query))
+        limit, after = parse_page_args(args)
+        if not is_plain_listing(args) or (after is not None and after >= product_id):
+            return None
+        result = remove_item(PRODUCT_FIELDS, product_id)(document, key)
+        if result and "next" in document["@controls"]:
+            return None
+        return result
+    return patch
+
+
+def refresh_products(products):
+    """
+    Patches the cached pages of the product collection with the current
+    state of the products, e.g. after their reviews or categories changed.
+    """
+    products = {product.id: product for product in products}
+    items = {}
+
+    def patch(document, key):
+        # The products may have moved in or out of sorted or filtered pages
+        if not is_plain_listing(dict(parse_qsl(urlsplit(key).query))):
+            return None
+        changed = False
+        for index, item in enumerate(document["items"]):
+            if item["id"] in products:
+                if item["id"] not in items:
+                    items[item["id"]] = product_item(products[item["id"]])
+                document["items"][index] = only_fields(
+                    items[item["id"]], key_fields(key, PRODUCT_FIELDS))
+                changed = True
+        return changed
+    patch_entry("products_all", patch,
+                [tag for product in products.values() for tag in product_tags(product)])
+
+
 class MasonBuilder(dict):
     """
     A convenience class for managing dictionaries that represent Mason
@@ -185,116 +791,90 @@ class MasonBuilder(dict):
 
 
 class CommerceMetaBuilder(MasonBuilder):
+    # The hrefs of the endpoints as format strings, see init_url_templates
+    url_templates = {}
+
+    def add_static_control(self, ctrl_name):
+        """
+        Adds one of the controls that are the same in every response, see
+        control_blocks. The control is shared and must not be changed.
+        """
+        self.setdefault("@controls", {})[ctrl_name] = control_blocks()[ctrl_name]
+
+    def add_control_edit(self, entity, href):
+        """
+        Adds the edit control of an item of the entity with its schema.
+        """
+        self.setdefault("@controls", {})["edit"] = {
+            **control_blocks()["edit:" + entity], "href": href}
+
     def add_control_users_all(self):
-        self.add_control(
-            "commercemeta:users-all",
-            api.url_for(UserCollection),
-            title="all users"
-        )
+        self.add_static_control("commercemeta:users-all")
 
     def add_control_products_all(self):
-        self.add_control(
-            "commercemeta:products-all",
-            url_for("products"),
-            title="all products"
-        )
+        self.add_static_control("commercemeta:products-all")
 
     def add_control_categories_all(self):
-        self.add_control(
-            "commercemeta:categories-all",
-            url_for("categories"),
-            title="all categories"
-        )
+        self.add_static_control("commercemeta:categories-all")
 
     def add_control_reviews_all(self):
+        self.add_static_control("commercemeta:reviews-all")
+
+    def add_control_reviews_for(self, username, product):
         self.add_control(
-            "commercemeta:reviews-all",
-            url_for("reviews"),
-            title="all reviews"
+            "commercemeta:reviews-for",
+            build_href("reviews_for", username=username, product=product),
+            title="reviews of the product"
         )
 
     def add_control_users_add(self):
-        self.add_control_post(
-            "commercemeta:add-user",
-            title="add new user",
-            href=api.url_for(UserCollection),
-            schema=User.json_schema()
-        )
+        self.add_static_control("commercemeta:add-user")
 
     def add_control_products_add(self):
-        self.add_control_post(
-            "commercemeta:add-product",
-            title="add new product",
-            href=api.url_for(ProductCollection),
-            schema=Product.json_schema()
-        )
+        self.add_static_control("commercemeta:add-product")
 
     def add_control_categories_add(self):
-        self.add_control_post(
-            "commercemeta:add-category",
-            title="add new category",
-            href=api.url_for(CategoryCollection),
-            schema=Category.json_schema()
-        )
+        self.add_static_control("commercemeta:add-category")
 
     def add_control_reviews_add(self):
-        self.add_control_post(
-            "commercemeta:add-review",
-            title="add new review",
-            href=api.url_for(ReviewCollection),
-            schema=Review.json_schema()
-        )
+        self.add_static_control("commercemeta:add-review")
 
     def add_control_edit_user(self, user):
-        self.add_control_put(
-            "edit",
-            api.url_for(UserItem, user=user),
-            User.json_schema()
-        )
+        self.add_control_edit("user", build_href("user", user=user))
 
     def add_control_edit_product(self, username, product):
-        self.add_control_put(
-            "edit",
-            api.url_for(ProductItem, username=username, product=product),
-            Product.json_schema()
-        )
+        self.add_control_edit(
+            "product", build_href("product", username=username, product=product))
 
     def add_control_edit_category(self, category):
-        self.add_control_put(
-            "edit",
-            api.url_for(CategoryItem, category=category),
-            Category.json_schema()
-        )
+        self.add_control_edit("category", build_href("category", category=category))
 
     def add_control_edit_review(self, username, product):
-        self.add_control_put(
-            "edit",
-            api.url_for(ReviewItem, username=username, product=product),
-            Review.json_schema()
-        )
+        self.add_control_edit(
+            "review", build_href("review", username=username, product=product))
 
     def add_control_delete_user(self, user):
         self.add_control_delete(
             "commercemeta:delete",
-            api.url_for(UserItem, user=user),
+            build_href("user", user=user),
         )
 
     def add_control_delete_product(self, username, product):
         self.add_control_delete(
             "commercemeta:delete",
-            api.url_for(ProductItem, username=username, product=product),
+            build_href("product", username=username, product=product),
         )
 
     def add_control_delete_category(self, category):
         self.add_control_delete(
             "commercemeta:delete",
-            api.url_for(CategoryItem, category=category),
+            build_href("category", category=category),
         )
 
     def add_control_delete_review(self, username, product):
         self.add_control_delete(
             "commercemeta:delete",
-            api.url_for(ReviewItem, username=username, product=product),
+            build_href("review", username=username, product=product),
         )
 
 
@@ -319,30 +899,34 @@ class UserItem(Resource):
         if is_authorized != "authorized":
             return is_authorized
 
-        cached_user = cache.get("user_"+str(user.id))
-        if cached_user:
-            return cached_user
-
-        cache.set("user_"+str(user.id), user.serialize())
+        fields = USER_ITEM_FIELDS.requested()
+        cached = cached_response("user_"+str(user.id))
+        if cached:
+            return cached
 
-        data = CommerceMetaBuilder(user.serialize())
+        data = CommerceMetaBuilder(user.serialize(fields=fields))
         # print(data)
         data.add_namespace("commercemeta", LINK_RELATIONS_URL)
         data.add_control("profile", href=USER_PROFILE_URL)
         data.add_control("self", href=request.path)
-        data.add_control("collection", href=api.url_for(UserCollection))
+        data.add_control("collection", href=build_href("users"))
         data.add_control_edit_user(user)
         data.add_control_delete_user(user)
         data.add_control(
             "commercemeta:reviews-by",
-            href=url_for("reviews_by", user=user)
+            href=build_href("reviews_by", user=user)
         )
         data.add_control(
             "commercemeta:products-by",
-            href=url_for("products_by_user", user=user)
+            href=build_href("products_by_user", user=user)
         )
 
-        return Response(json.dumps(data), 200, mimetype=MASON)
+        tags = ["user:"+str(user.id)]
+        tags += ["product:"+str(product.id) for product in user.products]
+        tags += ["product:"+str(review.product.id) for review in user.reviews]
+        return cache_response("user_"+str(user.id),
+                              Response(dumps(data), 200, mimetype=MASON),
+                              tags)
 
     def put(self, user):
         """
@@ -358,7 +942,7 @@ class UserItem(Resource):
         if is_authorized != "authorized":
             return is_authorized
         try:
-            validate(request.json, User.json_schema())
+            USER_VALIDATOR.validate(request.json)
             if 'email' in request.json:
                 is_valid_email = validate_email(
                     email_address=request.json["email"],
@@ -372,15 +956,22 @@ class UserItem(Resource):
                     raise BadRequest(description="Invalid Email")
         except ValidationError as e_v:
             raise BadRequest(description=str(e_v)) from e_v
+        old_name = user.name
         user.deserialize(request.json)
         try:
             db.session.add(user)
             db.session.commit()
-            cache.set("user_"+str(user.id), user.serialize())
-            cache.delete("users_all")
+            invalidate("user:"+str(user.id), "users", keep=["users_all"])
+            patch_entry("users_all", replace_item(user_item(user), USER_FIELDS, old_name))
+            forget_names(User, old_name, user.name)
+            if user.name != old_name:
+                # The products and reviews of the user carry the user's name
+                invalidate("products", "reviews",
+                           *["product:"+str(product.id) for product in user.products],
+                           *["review:"+str(review.id) for review in user.reviews])
         except IntegrityError as exc:
             raise Conflict(
-                description="Cannot modify username, since it has references in other tables."
+                description="A user with this name or email already exists."
             ) from exc
         return Response(status=204)
 
@@ -393,9 +984,12 @@ class UserItem(Resource):
         is_authorized = authorize_user(auth_header)
         if is_authorized != "authorized":
             return is_authorized
+        name = user.name
         db.session.delete(user)
         db.session.commit()
-        cache.delete("users_all")
+        forget_names(User, name)
+        invalidate("user:"+str(user.id), "users", keep=["users_all"])
+        patch_entry("users_all", remove_item(USER_FIELDS, name))
         return Response(status=204)
 
 
@@ -418,11 +1012,18 @@ class UserCollection(Resource):
         if is_authorized != "authorized":
             return is_authorized
 
-        cached_users = cache.get("users_all")
-        if cached_users:
-            return Response(headers={"Content-Type": "application/json"},
-                            response=json.dumps(cached_users), status=200)
+        # Unknown fields are rejected before the cache is looked up
+        USER_FIELDS.requested()
+        cached = cached_response("users_all", revalidate=self.render)
+        if cached:
+            return cached
+        return cache_response("users_all", *self.render())
 
+    def render(self):
+        """
+        This function builds the response listing all users and returns it
+        with the tags to cache it with.
+        """
         data = CommerceMetaBuilder(items=[])
         data.add_namespace("commercemeta", LINK_RELATIONS_URL)
         data.add_control("self", href=request.path)
@@ -430,25 +1031,16 @@ class UserCollection(Resource):
         data.add_control_products_all()
         data.add_control_reviews_all()
 
-        users = User.query.all()
+        fields = USER_FIELDS.requested()
+        users = User.query.options(*USER_FIELDS.load(fields)).order_by(User.id).all()
         #data["items"] = []
         #users_json = []
         for user in users:
-            item = CommerceMetaBuilder({
-                'name': user.name,
-                'password': user.password,
-                'email': user.email,
-                'role': user.role,
-                'avatar': user.avatar,
-                # 'products': [product.serialize() for product in user.products],
-                # 'reviews': [review.serialize() for review in user.reviews]
-            })
-            item.add_control("item", api.url_for(UserItem, user=user))
-            data["items"].append(item)
+            data["items"].append(user_item(user, fields))
 
-        cache.set("users_all", data["items"])
-        return Response(headers={"Content-Type": "application/json"},
-                        response=json.dumps(data), status=200, mimetype=MASON)
+        return Response(
+            headers={"Content-Type": "application/json"},
+            response=dumps(data), status=200, mimetype=MASON), ["users"]
 
     def post(self):
         """
@@ -459,7 +1051,7 @@ class UserCollection(Resource):
         if request.content_type != 'application/json':
             raise UnsupportedMediaType
         try:
-            validate(request.json, User.json_schema())
+            USER_VALIDATOR.validate(request.json)
             is_valid_email = validate_email(
                 email_address=request.json["email"],
                 check_format=True,
@@ -487,20 +1079,21 @@ class UserCollection(Resource):
             db.session.commit()
             # generate the auth token
             auth_token = user.encode_auth_token(user.name)
-            cache.set("user_"+str(user.id), user.serialize())
         except IntegrityError as exc:
             raise Conflict(
                 description=f"User with name {request.json['name']} or email \
                 {request.json['email']} already exists"
             ) from exc
-        cache.delete("users_all")
+        forget_names(User, user.name)
+        invalidate("users", keep=["users_all"])
+        patch_entry("users_all", append_item(user_item(user), USER_FIELDS))
         response_object = {
             'status': 'success',
             'message': 'Successfully registered.',
             'auth_token': auth_token
         }
         response = make_response(jsonify(response_object))
-        api_url = api.url_for(UserItem, user=user)
+        api_url = build_href("user", user=user)
         response.headers['location'] = api_url
         response.status_code = 201
         return response
@@ -545,14 +1138,17 @@ class UserAuth(Resource):
         else:
             auth_token = ''
         if auth_token:
-            resp = User.decode_auth_token(auth_token)
-            if 'token blacklisted' not in resp.lower() and 'signature expired' not in resp.lower() and 'invalid token' not in resp.lower():
+            _, error = User.verify_auth_token(auth_token)
+            if not error:
                 # mark the token as blacklisted
                 blacklist_token = BlacklistToken(token=auth_token)
                 try:
                     # insert the token
                     db.session.add(blacklist_token)
                     db.session.commit()
+                    current_app.extensions["blacklist_index"].add(
+                        blacklist_token.id, auth_token)
+                    current_app.extensions["token_cache"].discard(auth_token)
                     response_object = {
                         'status': 'success',
                         'message': 'Successfully logged out.'
@@ -571,7 +1167,7 @@ class UserAuth(Resource):
             else:
                 response_object = {
                     'status': 'fail',
-                    'message': resp
+                    'message': error
                 }
                 response = make_response(jsonify(response_object))
                 response.status_code = 401
@@ -604,37 +1200,41 @@ class ProductItem(Resource):
         is_authorized = authorize_user(auth_header)
         if is_authorized != "authorized":
             return is_authorized
-        user = User.query.filter_by(name=username).first()
+        fields = PRODUCT_ITEM_FIELDS.requested()
+        # Keyed by name, so that a hit is served before any query
+        cached = cached_response("product_"+product)
+        if cached:
+            return cached
         prod = Product.query.filter_by(name=product).first()
         if not prod:
             raise Conflict(
                 description="This product doesn't exist in db."
             )
 
-        cached_product = cache.get("product_"+str(prod.id))
-        if cached_product:
-            return cached_product
-
-        cache.set("product_"+str(prod.id), prod.serialize())
-
-        data = CommerceMetaBuilder(prod.serialize())
+        data = CommerceMetaBuilder(prod.serialize(fields=fields))
         data.add_namespace("commercemeta", LINK_RELATIONS_URL)
         data.add_control("profile", href=PRODUCT_PROFILE_URL)
         data.add_control("self", href=request.path)
-        data.add_control("collection", href=api.url_for(ProductCollection))
+        data.add_control("collection", href=build_href("products"))
         data.add_control_edit_product(username, product)
         data.add_control_delete_product(username, product)
         data.add_control(
             "commercemeta:products-by",
-            href=url_for("products_by_user", user=prod.user_name)
-        )
-        data.add_control(
-            "commercemeta:products-by",
-            href=url_for("products_by_category",
-                         category=prod.categories[0].name)
+            href=build_href("products_by_user", user=prod.user_name)
         )
+        if prod.categories:
+            data.add_control(
+                "commercemeta:products-by",
+                href=build_href("products_by_category",
+                                category=prod.categories[0].name)
+            )
 
-        return Response(json.dumps(data), 200, mimetype=MASON)
+        tags = ["product:"+str(prod.id)]
+        tags += ["category:"+str(category.id) for category in prod.categories]
+        tags += ["user:"+str(review.user.id) for review in prod.reviews]
+        return cache_response("product_"+product,
+                              Response(dumps(data), 200, mimetype=MASON),
+                              tags)
 
     def put(self, username, product):
         """
@@ -650,7 +1250,7 @@ class ProductItem(Resource):
         if is_authorized != "authorized":
             return is_authorized
         try:
-            validate(request.json, Product.json_schema())
+            PRODUCT_VALIDATOR.validate(request.json)
         except ValidationError as e_v:
             raise BadRequest(description=str(e_v)) from e_v
         # user = User.query.filter_by(name=username).first()
@@ -660,7 +1260,12 @@ class ProductItem(Resource):
                 description="This product doesn't exist in db."
             )
 
+        user = User.query.filter_by(name=request.json['user_name']).first()
+        if user is None:
+            raise BadRequest(description="User_name doesn't exist in db.")
+        old_name = prod.name
         prod.deserialize(request.json)
+        prod.user = user
         #user = None
         # if 'user_name' in request.json:
         # try:
@@ -685,8 +1290,15 @@ class ProductItem(Resource):
         try:
             db.session.add(prod)
             db.session.commit()
-            cache.set("prod_"+str(prod.id), prod.serialize())
-            cache.delete("products_all")
+            # The entries of the old seller and categories embed the product,
+            # the ones of the new seller and categories do not yet
+            invalidate("product:"+str(prod.id), "user:"+str(prod.user.id),
+                       *["category:"+str(category.id) for category in prod.categories],
+                       keep=["products_all"])
+            refresh_products([prod])
+            if prod.name != old_name:
+                # The reviews of the product carry the product's name
+                invalidate("reviews", *["review:"+str(review.id) for review in prod.reviews])
         except IntegrityError as exc:
             raise Conflict(
                 description="Cannot update fields that are referenced in other tables."
@@ -701,7 +1313,8 @@ class ProductItem(Resource):
         if prod:
             db.session.delete(prod)
             db.session.commit()
-            cache.delete("products_all")
+            invalidate("product:"+str(prod.id), "products", keep=["products_all"])
+            patch_entry("products_all", remove_product(prod.id))
             return Response(status=204)
         return Response(status=404)
 
@@ -717,51 +1330,47 @@ class ProductCollection(Resource):
     def get(self):
         """
         This function is used to fetch and return the information of all
-        products in the db.
+        products in the db. The products are paginated with a keyset cursor:
+        ?limit= sets the page size and ?after= the id of the last product of
+        the previous page. Pages are linked with next and prev controls.
         """
-        cached_products = cache.get("products_all")
-        if cached_products:
-            return Response(headers={"Content-Type": "application/json"},
-                            response=json.dumps(cached_products), status=200)
-
+        # Invalid page, listing arguments and fields are rejected before the
+        # cache is looked up
+        parse_page_args()
+        parse_listing_args()
+        PRODUCT_FIELDS.requested()
+        cached = cached_response("products_all", revalidate=self.render)
+        if cached:
+            return cached
+        return cache_response("products_all", *self.render())
+
+    def render(self):
+        """
+        This function builds the requested page of products and returns it
+        with the tags to cache it with.
+        """
+        listing = parse_listing_args()
+        fields = PRODUCT_FIELDS.requested()
         data = CommerceMetaBuilder(items=[])
         data.add_namespace("commercemeta", LINK_RELATIONS_URL)
         data.add_control("self", href=request.path)
         data.add_control_products_add()
         data.add_control_users_all()
         data.add_control_categories_all()
-        products = Product.query.all()
 
-        for product in products:
-            item = CommerceMetaBuilder({
-                'id': product.id,
-                'name': product.name,
-                'price': product.price,
-                'description': product.description,
-                'images': json.loads(product.images) if product.images else None,
-                'user_name': product.user_name,
-                'reviews': [review.serialize(include_product=False, include_user=False) for review in product.reviews],
-                'categories': [category.serialize(long=False) for category in product.categories],
-            })
-            # print(item["user_name"])
-            item.add_control("item", api.url_for(
-                ProductItem, product=item["name"], username=item["user_name"]))
-            item.add_control(
-                "commercemeta:products-by",
-                href=url_for("products_by_user", user=item["user_name"])
-            )
-            if len(item["categories"]) > 0:
-                item.add_control(
-                    "commercemeta:products-by",
-                    href=url_for("products_by_category",
-                                 category=item["categories"][0]["name"])
-                )
+        products = page_products(
+            data, filter_products(Product.query.options(*PRODUCT_FIELDS.load(fields)), listing),
+            filter_products(db.session.query(Product.id), listing), listing)
 
-            data["items"].append(item)
+        for product in products:
+            data["items"].append(product_item(product, fields))
 
-        cache.set("products_all", data["items"])
-        return Response(headers={"Content-Type": "application/json"},
-                        response=json.dumps(data), status=200, mimetype=MASON)
+        tags = ["products"]
+        for product in products:
+            tags += product_tags(product)
+        return Response(
+            headers={"Content-Type": "application/json"},
+            response=dumps(data), status=200, mimetype=MASON), tags
 
     def post(self):
         """
@@ -776,7 +1385,7 @@ class ProductCollection(Resource):
         if is_authorized != "authorized":
             return is_authorized
         try:
-            validate(request.json, Product.json_schema())
+            PRODUCT_VALIDATOR.validate(request.json)
         except ValidationError as e_v:
             raise BadRequest(description=str(e_v)) from e_v
 
@@ -804,12 +1413,14 @@ class ProductCollection(Resource):
                 product.categories = categories
             db.session.add(product)
             db.session.commit()
-            cache.set("product_"+str(product.id), product.serialize())
         except IntegrityError as e_i:
             raise Conflict(
                 description=e_i
             ) from e_i
-        cache.delete("products_all")
+        tags = ["user:"+str(user.id)] if user else []
+        tags += ["category:"+str(category.id) for category in product.categories]
+        invalidate("products", *tags, keep=["products_all"])
+        patch_entry("products_all", append_product(product), product_tags(product))
        # NOTE:: CAN BE OF USE WHEN LINKING PRODUCTS TO CATEGORIES
        # WHEN CREATING PRODUCTS, CREATES CATEGORIES IF THEY ARE NOT YET CREATED
        # try:
@@ -836,8 +1447,8 @@ class ProductCollection(Resource):
        # category: {request.json["category"]}'
        #     )
         response = make_response()
-        api_url = api.url_for(
-            ProductItem, username=user.name, product=product.name)
+        api_url = build_href(
+            "product", username=user.name, product=product.name)
         response.headers['location'] = api_url
         response.status_code = 201
         return response
@@ -847,13 +1458,15 @@ class ProductsByUser(Resource):
 
     def get(self, user):
 
+        parse_page_args()
+        listing = parse_listing_args()
+        fields = PRODUCT_FIELDS.requested()
+        cached = cached_response("products_by_user:"+user)
+        if cached:
+            return cached
         product_user = User.query.filter_by(name=user).first()
-        products = product_user.products
-
-        #cached_products = cache.get("products_all")
-        # if cached_products:
-        # return Response(headers={"Content-Type": "application/json"},
-        # response=json.dumps(cached_products), status=200)
+        if product_user is None:
+            raise NotFound
 
         #user = User.query.all()
 
@@ -861,70 +1474,79 @@ class ProductsByUser(Resource):
         data.add_namespace("commercemeta", LINK_RELATIONS_URL)
         data.add_control("self", href=request.path)
         data.add_control_products_all()
+        products = page_products(
+            data,
+            filter_products(Product.query.options(*PRODUCT_FIELDS.load(fields)).filter_by(
+                user_id=product_user.id), listing),
+            filter_products(db.session.query(Product.id).filter_by(
+                user_id=product_user.id), listing),
+            listing)
 
         #products_json = []
         #data["items"] = []
         for product in products:
-            item = CommerceMetaBuilder({
-                'id': product.id,
-                'name': product.name,
-                'price': product.price,
-                'description': product.description,
-                'images': json.loads(product.images) if product.images else None,
-                'user_name': product.user_name,
-                'reviews': [review.serialize(include_product=False, include_user=False) for review in product.reviews],
-                'categories': [category.serialize(long=False) for category in product.categories],
-            })
-            item.add_control("item", api.url_for(
-                ProductItem, product=item["name"]))
-            item.add_control("customer", api.url_for(
-                UserItem, user=item["user_name"]))
+            item = CommerceMetaBuilder(product_fields(product, fields))
+            item.add_control("item", build_href(
+                "product", username=product.user_name, product=product.name))
+            item.add_control_reviews_for(product.user_name, product.name)
+            item.add_control("customer", build_href(
+                "user", user=product_user))
             data["items"].append(item)
 
-        cache.set("products_all", data["items"])
-        return Response(headers={"Content-Type": "application/json"},
-                        response=json.dumps(data), status=200, mimetype=MASON)
+        tags = ["user:"+str(product_user.id)]
+        for product in products:
+            tags.append("product:"+str(product.id))
+            tags += ["category:"+str(category.id) for category in product.categories]
+        return cache_response("products_by_user:"+user, Response(
+            headers={"Content-Type": "application/json"},
+            response=dumps(data), status=200, mimetype=MASON), tags)
 
 
 class ProductsByCategory(Resource):
 
     def get(self, category):
 
+        parse_page_args()
+        listing = parse_listing_args()
+        fields = PRODUCT_FIELDS.requested()
+        cached = cached_response("products_by_category:"+category)
+        if cached:
+            return cached
         product_category = Category.query.filter_by(name=category).first()
-        products = product_category.products
+        if product_category is None:
+            raise NotFound
 
-        #cached_products = cache.get("products_all")
-        # if cached_products:
-        # return Response(headers={"Content-Type": "application/json"},
-        # response=json.dumps(cached_products), status=200)
         #user = User.query.all()
         data = CommerceMetaBuilder(items=[])
         data.add_namespace("commercemeta", LINK_RELATIONS_URL)
         data.add_control("self", href=request.path)
         data.add_control_products_all()
+        products = page_products(
+            data,
+            filter_products(Product.query.options(*PRODUCT_FIELDS.load(fields)).join(
+                Product.categories).filter(Category.id == product_category.id), listing),
+            filter_products(db.session.query(Product.id).join(Product.categories).filter(
+                Category.id == product_category.id), listing),
+            listing)
 
         #products_json = []
         #data["items"] = []
         for product in products:
-            item = CommerceMetaBuilder({
-                'id': product.id,
-                'name': product.name,
-                'price': product.price,
-                'description': product.description,
-                'images': json.loads(product.images) if product.images else None,
-                'user_name': product.user_name,
-                'reviews': [review.serialize(include_product=False, include_user=False) for review in product.reviews],
-                'categories': [category.serialize(long=False) for category in product.categories],
-            })
-            item.add_control("item", api.url_for(
-                ProductItem, username=item["user_name"], product=item["name"]))
-            item.add_control("category", api.url_for(CategoryItem, category=Category.query.filter_by(
-                name=item["categories"][0]["name"]).first()))
+            item = CommerceMetaBuilder(product_fields(product, fields))
+            item.add_control("item", build_href(
+                "product", username=product.user_name, product=product.name))
+            item.add_control_reviews_for(product.user_name, product.name)
+            item.add_control("category", build_href(
+                "category", category=product.categories[0]))
             data["items"].append(item)
 
-        cache.set("products_all", data["items"])
-        return Response(headers={"Content-Type": "application/json"},
-                        response=json.dumps(data), status=200, mimetype=MASON)
+        tags = ["category:"+str(product_category.id)]
+        for product in products:
+            tags.append("product:"+str(product.id))
+            tags += ["category:"+str(category.id) for category in product.categories]
+        return cache_response("products_by_category:"+category, Response(
+            headers={"Content-Type": "application/json"},
+            response=dumps(data), status=200, mimetype=MASON), tags)
 
 
 class ReviewItem(Resource):
@@ -943,14 +1565,15 @@ class ReviewItem(Resource):
         is_authorized = authorize_user(auth_header)
         if is_authorized != "authorized":
             return is_authorized
-        review = Review.query.filter_by(user_name=username).first()
+        fields = REVIEW_ITEM_FIELDS.requested()
+        cached = cached_response("review_"+username+"/"+product)
+        if cached:
+            return cached
+        review = find_review(username, product)
         if not review:
             raise Conflict(
                 description="No review to this product by this user.")
         prod = Product.query.filter_by(name=product).first()
-        cached_review = cache.get("review_"+str(review.id))
-        if cached_review:
-            return cached_review
 
         # TODO:: Are these exceptions dead code?
         # If product doesn't exist, you cannot create a review for it
@@ -960,26 +1583,22 @@ class ReviewItem(Resource):
             raise Conflict(
                 description="This product doesn't exist in db."
             )
-        if not Review.query.filter_by(user_name=username).filter_by(product_name=product).\
-                first():
-            raise Conflict(
-                description="This review doesn't exist in db."
-            )
-        cache.set("review_"+str(review.id), review.serialize())
-
-        data = CommerceMetaBuilder(review.serialize())
+        data = CommerceMetaBuilder(review.serialize(fields=fields))
         data.add_namespace("commercemeta", LINK_RELATIONS_URL)
         data.add_control("profile", href=REVIEW_PROFILE_URL)
         data.add_control("self", href=request.path)
-        data.add_control("collection", href=url_for("reviews"))
+        data.add_control("collection", href=build_href("reviews"))
         data.add_control_edit_review(username, product)
         data.add_control_delete_review(username, product)
         data.add_control(
             "commercemeta:reviews-by",
-            href=url_for("reviews_by", user=review.user_name)
+            href=build_href("reviews_by", user=review.user_name)
         )
         #print(user, username)
-        return Response(json.dumps(data), 200, mimetype=MASON)
+        return cache_response("review_"+username+"/"+product,
+                              Response(dumps(data), 200, mimetype=MASON),
+                              ["review:"+str(review.id), "user:"+str(review.user.id),
+                               "product:"+str(review.product.id)])
 
     def put(self, username, product):
         """
@@ -995,27 +1614,45 @@ class ReviewItem(Resource):
         if is_authorized != "authorized":
             return is_authorized
         try:
-            validate(request.json, Review.json_schema())
+            REVIEW_VALIDATOR.validate(request.json)
         except ValidationError as e_v:
             raise BadRequest(description=str(e_v)) from e_v
 
         prod = Product.query.filter_by(name=product).first()
-        review = Review.query.filter_by(user_name=username).first()
+        review = find_review(username, product)
         #print (prod, review)
         if not prod:
             raise Conflict(
                 description="This product doesn't exist in db."
             )
-        if not Review.query.filter_by(user_name=username).filter_by(product_name=product).first():
+        if not review:
             raise Conflict(
                 description="This review doesn't exist in db."
             )
+        # The review may be moved to another user or product, so the entries
+        # embedding it before and after the change are both invalidated
+        old_product = review.product
+        tags = ["review:"+str(review.id),
+                "user:"+str(review.user.id), "product:"+str(review.product.id)]
+        old_rating = review.rating
+        user = User.query.filter_by(name=request.json['user_name']).first()
+        new_product = Product.query.filter_by(name=request.json['product_name']).first()
+        if user is None or new_product is None:
+            raise Conflict(
+                description="Product_name or user_name doesn't exist in db."
+            )
         review.deserialize(request.json)
+        review.user = user
+        review.product = new_product
         try:
             db.session.add(review)
+            Product.add_rating(old_product.id, old_rating, -1)
+            Product.add_rating(review.product.id, review.rating)
             db.session.commit()
-            cache.set("review_"+str(review.id), review.serialize())
-            cache.delete("reviews_all")
+            invalidate("reviews", "user:"+str(review.user.id), "product:"+str(review.product.id),
+                       *tags, keep=["products_all", "reviews_all"])
+            patch_entry("reviews_all", replace_item(review_item(review), REVIEW_FIELDS, review.id))
+            refresh_products([old_product, review.product])
 
             # TODO:: Is below dead code?
             # The API resource path doesn't
@@ -1024,7 +1661,8 @@ class ReviewItem(Resource):
             # You cannot delete a product without deleting the review first (cascading delete)
         except IntegrityError:
             raise Conflict(
-                description="Product_name or user_name doesn't exist in db."
+                description="Product_name or user_name doesn't exist in db, "
+                "or the user has already reviewed the product."
             )
         return Response(status=204)
 
@@ -1036,12 +1674,16 @@ class ReviewItem(Resource):
         is_authorized = authorize_user(auth_header)
         if is_authorized != "authorized":
             return is_authorized
-        review = Review.query.filter_by(
-            user_name=username, product_name=product).first()
+        review = find_review(username, product)
         if review:
+            user_id, review_product = review.user_id, review.product
             db.session.delete(review)
+            Product.add_rating(review_product.id, review.rating, -1)
             db.session.commit()
-            cache.delete("reviews_all")
+            invalidate("review:"+str(review.id), "reviews", "user:"+str(user_id),
+                       "product:"+str(review_product.id), keep=["products_all", "reviews_all"])
+            patch_entry("reviews_all", remove_item(REVIEW_FIELDS, review.id))
+            refresh_products([review_product])
             return Response(status=204)
         return Response(status=409)
 
@@ -1062,43 +1704,36 @@ class ReviewCollection(Resource):
         is_authorized = authorize_user(auth_header)
         if is_authorized != "authorized":
             return is_authorized
-        cached_reviews = cache.get("reviews_all")
-        if cached_reviews:
-            return Response(headers={"Content-Type": "application/json"},
-                            response=json.dumps(cached_reviews), status=200)
+        # Unknown fields are rejected before the cache is looked up
+        REVIEW_FIELDS.requested()
+        cached = cached_response("reviews_all", revalidate=self.render)
+        if cached:
+            return cached
+        return cache_response("reviews_all", *self.render())
+
+    def render(self):
+        """
+        This function builds the response listing all reviews and returns it
+        with the tags to cache it with.
+        """
         data = CommerceMetaBuilder(items=[])
         data.add_namespace("commercemeta", LINK_RELATIONS_URL)
         data.add_control("self", href=request.path)
         data.add_control_reviews_add()
         data.add_control_users_all()
 
-        reviews = Review.query.all()
+        fields = REVIEW_FIELDS.requested()
+        reviews = Review.query.options(*REVIEW_FIELDS.load(fields)).order_by(Review.id).all()
         #reviews_json = []
         #data["items"] = []
         for review in reviews:
-            item = CommerceMetaBuilder({
-                'id': review.id,
-                'description': review.description,
-                'rating': review.rating,
-                'user_name': review.user_name,
-                'product_name': review.product_name,
-                # 'user': review.user.serialize(),
-                # 'product': review.product.serialize(),
-            })
-            item.add_control("item", api.url_for(
-                ReviewItem, product=item["product_name"], username=item["user_name"]))
-            item.add_control(
-                "commercemeta:reviews-by",
-                href=url_for("reviews_by", user=item["user_name"])
-            )
-            data["items"].append(item)
+            data["items"].append(review_item(review, fields))
 
-        cache.set("reviews_all", data["items"])
         return Response(
             headers={"Content-Type": "application/json"},
-            response=json.dumps(data),
+            response=dumps(data),
             status=200, mimetype=MASON
-        )
+        ), ["reviews"]
 
     def post(self):
         """
@@ -1114,7 +1749,7 @@ class ReviewCollection(Resource):
         if is_authorized != "authorized":
             return is_authorized
         try:
-            validate(request.json, Review.json_schema())
+            REVIEW_VALIDATOR.validate(request.json)
         except ValidationError as e_v:
             raise BadRequest(description=str(e_v)) from e_v
 
@@ -1135,12 +1770,21 @@ class ReviewCollection(Resource):
         except (ValueError, KeyError, IntegrityError) as e_v:
             return Response(response=str(e_v), status=400)
         db.session.add(review)
-        db.session.commit()
-        cache.set("review_"+str(review.id), review.serialize())
-        cache.delete("reviews_all")
+        try:
+            Product.add_rating(product.id, review.rating)
+            db.session.commit()
+        except IntegrityError as exc:
+            db.session.rollback()
+            raise Conflict(
+                description="The user has already reviewed this product."
+            ) from exc
+        invalidate("reviews", "user:"+str(user.id), "product:"+str(product.id),
+                   keep=["products_all", "reviews_all"])
+        patch_entry("reviews_all", append_item(review_item(review), REVIEW_FIELDS))
+        refresh_products([product])
         response = make_response()
-        api_url = api.url_for(
-            ReviewItem, username=user.name, product=product.name)
+        api_url = build_href(
+            "review", username=user.name, product=product.name)
         response.headers['location'] = api_url
         response.status_code = 201
         return response
@@ -1154,13 +1798,16 @@ class ReviewsByUser(Resource):
         if is_authorized != "authorized":
             return is_authorized
 
-        #review_user = User.query.filter_by(name=user).first()
-        reviews = User.query.filter_by(name=user).first().reviews
+        fields = REVIEW_FIELDS.requested()
+        cached = cached_response("reviews_by_user:"+user)
+        if cached:
+            return cached
+        review_user = User.query.filter_by(name=user).first()
+        if review_user is None:
+            raise NotFound
+        reviews = Review.query.options(*REVIEW_FIELDS.load(fields)).filter_by(
+            user_id=review_user.id).order_by(Review.id).all()
 
-        #cached_reviews = cache.get("reviews_all")
-        # if cached_reviews:
-        # return Response(headers={"Content-Type": "application/json"},
-        # response=json.dumps(cached_reviews), status=200)
         data = CommerceMetaBuilder(items=[])
         data.add_namespace("commercemeta", LINK_RELATIONS_URL)
         data.add_control("self", href=request.path)
@@ -1169,26 +1816,64 @@ class ReviewsByUser(Resource):
         #reviews_json = []
         #data["items"] = []
         for review in reviews:
-            item = CommerceMetaBuilder({
-                'id': review.id,
-                'description': review.description,
-                'rating': review.rating,
-                'user_name': review.user_name,
-                'product_name': review.product_name,
-                # 'user': review.user.serialize(),
-                # 'product': review.product.serialize(),
-            })
-            item.add_control("item", api.url_for(
-                ReviewItem, username=item["user_name"], product=item["product_name"]))
-            item.add_control("customer", api.url_for(UserItem, user=user))
+            item = CommerceMetaBuilder(review_fields(review, fields))
+            item.add_control("item", build_href(
+                "review", username=review.user_name, product=review.product_name))
+            item.add_control("customer", build_href("user", user=review_user))
             data["items"].append(item)
 
-        cache.set("reviews_all", data["items"])
-        return Response(
+        tags = ["user:"+str(review_user.id)]
+        tags += ["review:"+str(review.id) for review in reviews]
+        return cache_response("reviews_by_user:"+user, Response(
             headers={"Content-Type": "application/json"},
-            response=json.dumps(data),
+            response=dumps(data),
             status=200, mimetype=MASON
-        )
+        ), tags)
+
+
+class ReviewsForProduct(Resource):
+    """
+    This class holds the full reviews of a product, which product listings
+    only summarize. The class can be accessed through
+    api/users/<username>/products/<product>/reviews/.
+    """
+
+    def get(self, username, product):
+        """
+        This function fetches and returns the reviews of a product.
+        """
+
+        auth_header = request.headers.get('Authorization')
+        is_authorized = authorize_user(auth_header)
+        if is_authorized != "authorized":
+            return is_authorized
+
+        fields = REVIEW_FIELDS.requested()
+        cached = cached_response("reviews_for:"+product)
+        if cached:
+            return cached
+        prod = Product.query.filter_by(name=product).first()
+        if prod is None:
+            raise NotFound
+        reviews = Review.query.options(*REVIEW_FIELDS.load(fields)).filter_by(
+            product_id=prod.id).order_by(Review.id).all()
+
+        data = CommerceMetaBuilder(items=[])
+        data.add_namespace("commercemeta", LINK_RELATIONS_URL)
+        data.add_control("self", href=request.path)
+        data.add_control("up", href=build_href(
+            "product", username=prod.user_name, product=prod.name))
+        data.add_control_reviews_all()
+        for review in reviews:
+            data["items"].append(review_item(review, fields))
+
+        tags = ["product:"+str(prod.id)]
+        tags += ["review:"+str(review.id) for review in reviews]
+        return cache_response("reviews_for:"+product, Response(
+            headers={"Content-Type": "application/json"},
+            response=dumps(data),
+            status=200, mimetype=MASON
+        ), tags)
 
 
 class CategoryItem(Resource):
@@ -1208,23 +1893,27 @@ class CategoryItem(Resource):
         is_authorized = authorize_user(auth_header)
         if is_authorized != "authorized":
             return is_authorized
-        cached_category = cache.get("category_"+str(category.id))
-        if cached_category:
-            return cached_category
-        cache.set("category_"+str(category.id), category.serialize())
+        fields = CATEGORY_ITEM_FIELDS.requested()
+        cached = cached_response("category_"+str(category.id))
+        if cached:
+            return cached
 
-        data = CommerceMetaBuilder(category.serialize())
+        data = CommerceMetaBuilder(category.serialize(fields=fields))
         data.add_namespace("commercemeta", LINK_RELATIONS_URL)
         data.add_control("profile", href=CATEGORY_PROFILE_URL)
         data.add_control("self", href=request.path)
-        data.add_control("collection", href=api.url_for(CategoryCollection))
+        data.add_control("collection", href=build_href("categories"))
         data.add_control_edit_category(category)
         data.add_control_delete_category(category)
         # data.add_control(
         # "commercemeta:products-by",
         #href=url_for("products_by_category", category=category)
         # )
-        return Response(json.dumps(data), 200, mimetype=MASON)
+        tags = ["category:"+str(category.id)]
+        tags += ["product:"+str(product.id) for product in category.products]
+        return cache_response("category_"+str(category.id),
+                              Response(dumps(data), 200, mimetype=MASON),
+                              tags)
 
     def put(self, category):
         """
@@ -1240,9 +1929,11 @@ class CategoryItem(Resource):
         if is_authorized != "authorized":
             return is_authorized
         try:
-            validate(request.json, Category.json_schema())
+            CATEGORY_VALIDATOR.validate(request.json)
         except ValidationError as e_v:
             raise BadRequest(description=str(e_v)) from e_v
+        old_products = list(category.products)
+        old_name = category.name
         category.deserialize(request.json)
         if 'product_names' in request.json:
             products = Product.query.filter(
@@ -1252,8 +1943,13 @@ class CategoryItem(Resource):
             category.products = products
         db.session.add(category)
         db.session.commit()
-        cache.set("category_"+str(category.id), category.serialize())
-        cache.delete("categories_all")
+        forget_names(Category, old_name, category.name)
+        # Products newly linked to the category do not embed it yet
+        invalidate("category:"+str(category.id), "categories",
+                   *["product:"+str(product.id) for product in category.products],
+                   keep=["products_all", "categories_all"])
+        patch_entry("categories_all", replace_item(category_item(category), CATEGORY_FIELDS, category.id))
+        refresh_products(old_products + category.products)
         return Response(status=204)
 
     def delete(self, category):
@@ -1265,9 +1961,15 @@ class CategoryItem(Resource):
         is_authorized = authorize_user(auth_header)
         if is_authorized != "authorized":
             return is_authorized
+        products = list(category.products)
+        name = category.name
         db.session.delete(category)
         db.session.commit()
-        cache.delete("categories_all")
+        forget_names(Category, name)
+        invalidate("category:"+str(category.id), "categories",
+                   keep=["products_all", "categories_all"])
+        patch_entry("categories_all", remove_item(CATEGORY_FIELDS, category.id))
+        refresh_products(products)
         return Response(status=204)
 
 
@@ -1283,32 +1985,33 @@ class CategoryCollection(Resource):
         """
         This function is used to fetch the information of all categories.
         """
-        cached_categories = cache.get("categories_all")
-        if cached_categories:
-            return Response(headers={"Content-Type": "application/json"},
-                            response=json.dumps(cached_categories), status=200)
+        # Unknown fields are rejected before the cache is looked up
+        CATEGORY_FIELDS.requested()
+        cached = cached_response("categories_all", revalidate=self.render)
+        if cached:
+            return cached
+        return cache_response("categories_all", *self.render())
+
+    def render(self):
+        """
+        This function builds the response listing all categories and returns
+        it with the tags to cache it with.
+        """
         data = CommerceMetaBuilder(items=[])
         data.add_namespace("commercemeta", LINK_RELATIONS_URL)
         data.add_control("self", href=request.path)
         data.add_control_categories_add()
         data.add_control_products_all()
-        categories = Category.query.all()
+        fields = CATEGORY_FIELDS.requested()
+        categories = Category.query.options(*CATEGORY_FIELDS.load(fields)).order_by(Category.id).all()
         #category_json = []
         data["items"] = []
         for category in categories:
-            item = CommerceMetaBuilder({
-                'id': category.id,
-                'name': category.name,
-                'image': category.image,
-                # 'products': [product.serialize(long=False) for product in category.products]
-            })
-            item.add_control("item", api.url_for(
-                CategoryItem, category=category))
-            data["items"].append(item)
+            data["items"].append(category_item(category, fields))
 
-        cache.set("categories_all", data["items"])
-        return Response(headers={"Content-Type": "application/json"},
-                        response=json.dumps(data), status=200, mimetype=MASON)
+        return Response(
+            headers={"Content-Type": "application/json"},
+            response=dumps(data), status=200, mimetype=MASON), ["categories"]
 
     def post(self):
         """
@@ -1323,7 +2026,7 @@ class CategoryCollection(Resource):
         if is_authorized != "authorized":
             return is_authorized
         try:
-            validate(request.json, Category.json_schema())
+            CATEGORY_VALIDATOR.validate(request.json)
         except ValidationError as e_v:
             raise BadRequest(description=str(e_v)) from e_v
         products = None
@@ -1341,15 +2044,39 @@ class CategoryCollection(Resource):
                 category.products = products
             db.session.add(category)
             db.session.commit()
-            cache.set("category_"+str(category.id), category.serialize())
         except IntegrityError:
             return Response("Category already exists", 409)
-        cache.delete("categories_all")
+        forget_names(Category, category.name)
+        invalidate("categories", *["product:"+str(product.id) for product in category.products],
+                   keep=["products_all", "categories_all"])
+        patch_entry("categories_all", append_item(category_item(category), CATEGORY_FIELDS))
+        refresh_products(category.products)
         response = make_response()
-        api_url = api.url_for(CategoryItem, category=category)
+        api_url = build_href("category", category=category)
         response.headers['location'] = api_url
         response.status_code = 201
         return response
+
+
+class SchemaItem(Resource):
+    """
+    This class serves the JSON schemas of the entities, which controls
+    reference by schemaUrl with SCHEMA_MODE "url". The class can be accessed
+    through /schemas/<entity>/. The schemas only change with the code, so
+    clients may cache them for SCHEMA_MAX_AGE seconds.
+    """
+
+    def get(self, entity):
+        """
+        This function returns the JSON schema of the entity.
+        """
+        if entity not in SCHEMA_BODIES:
+            raise NotFound
+        response = Response(SCHEMA_BODIES[entity], 200, mimetype="application/schema+json")
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config["SCHEMA_MAX_AGE"]
+        response.add_etag()
+        return response.make_conditional(request)
 # Routing resources
 
 
@@ -1370,6 +2097,9 @@ api.add_resource(
 api.add_resource(ReviewCollection, "/api/users/reviews/", endpoint="reviews")
 api.add_resource(ReviewsByUser, "/api/users/<user>/reviews/",
                  endpoint="reviews_by")
+api.add_resource(ReviewsForProduct, "/api/users/<username>/products/<product>/reviews/",
+                 endpoint="reviews_for")
 api.add_resource(
     CategoryItem, "/api/categories/<category:category>/", endpoint="category")
 api.add_resource(CategoryCollection, "/api/categories/", endpoint="categories")
+api.add_resource(SchemaItem, "/schemas/<entity>/", endpoint="schema")
@@ -0,0 +1,158 @@
+"""
+In this module, cache backends that are not shipped with Flask-Caching are
+defined. They are selected with the CACHE_TYPE config, e.g.
+CACHE_TYPE="productsapi.cache_backends.SQLiteCache".
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from flask_caching.backends.base import BaseCache
+
+
+class SQLiteCache(BaseCache):
+    """
+    Cache stored in a single SQLite file, so that every worker process of
+    the app on the same host shares one warm cache, and a delete done by
+    one worker is seen by all of them. The cache holds at most threshold
+    entries, the least recently used ones are evicted first.
+
+    :param path: path of the SQLite file holding the cache
+    :param threshold: the maximum number of entries kept in the cache
+    :param default_timeout: the timeout used when set is given none. A
+                            timeout of 0 means the entry never expires.
+    :param ignore_errors: whether delete_many should go on after a key
+                          that could not be deleted
+    """
+
+    # Reading an entry refreshes its access time at most this often, so
+    # that hot keys do not turn every read into a write.
+    touch_interval = 1.0
+
+    def __init__(self, path, threshold=500, default_timeout=300, ignore_errors=False):
+        BaseCache.__init__(self, default_timeout=default_timeout)
+        self.path = path
+        self.threshold = threshold
+        self.ignore_errors = ignore_errors
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                "expires REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_cache_accessed ON cache (accessed)")
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        path = config.get("CACHE_SQLITE_PATH") or os.path.join(
+            app.instance_path, "cache.sqlite")
+        kwargs.update(
+            dict(
+                path=path,
+                threshold=config["CACHE_THRESHOLD"],
+                ignore_errors=config["CACHE_IGNORE_ERRORS"],
+            )
+        )
+        return cls(*args, **kwargs)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _expires(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        return time.time() + timeout if timeout else 0
+
+    def get(self, key):
+        now = time.time()
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT value, expires, accessed FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        value, expires, accessed = row
+        if expires and expires <= now:
+            connection.execute(
+                "DELETE FROM cache WHERE key = ? AND expires = ?", (key, expires))
+            return None
+        if now - accessed > self.touch_interval:
+            connection.execute(
+                "UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        now = time.time()
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires, accessed) "
+            "VALUES (?, ?, ?, ?)",
+            (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), self._expires(timeout), now)
+        )
+        self._evict(connection, now)
+        return True
+
+    def add(self, key, value, timeout=None):
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                "DELETE FROM cache WHERE key = ? AND expires != 0 AND expires <= ?",
+                (key, now))
+            added = connection.execute(
+                "INSERT OR IGNORE INTO cache (key, value, expires, accessed) "
+                "VALUES (?, ?, ?, ?)",
+                (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), self._expires(timeout), now)
+            ).rowcount == 1
+        if added:
+            self._evict(connection, now)
+        return added
+
+    def delete(self, key):
+        return self._connection().execute(
+            "DELETE FROM cache WHERE key = ?", (key,)).rowcount == 1
+
+    def has(self, key):
+        row = self._connection().execute(
+            "SELECT expires FROM cache WHERE key = ?", (key,)).fetchone()
+        return row is not None and (not row[0] or row[0] > time.time())
+
+    def clear(self):
+        self._connection().execute("DELETE FROM cache")
+        return True
+
+    def inc(self, key, delta=1):
+        """
+        Increments the value of a key atomically across processes.
+        """
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            value = (self.get(key) or 0) + delta
+            self.set(key, value)
+        return value
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+    def _evict(self, connection, now):
+        count = connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if count <= self.threshold:
+            return
+        connection.execute(
+            "DELETE FROM cache WHERE expires != 0 AND expires <= ?", (now,))
+        connection.execute(
+            "DELETE FROM cache WHERE key IN ("
+            "SELECT key FROM cache ORDER BY accessed LIMIT max(0, "
+            "(SELECT COUNT(*) FROM cache) - ?))",
+            (self.threshold,)
+        )
@@ -0,0 +1,469 @@
+"""
+In this module, the cache object and the response cache built on it are
+defined. The response cache stores the final encoded body of a response,
+so a cache hit is answered without rebuilding or encoding the Mason
+document.
+
+Each cache entry (e.g. "products_all" or "user_3") is a dict mapping the
+representations of the entry, i.e. the paths with the query parameters
+selecting a representation, to the encoded body, ETag, content type and
+the generations of the tags it was built from, see below. Deleting the
+entry invalidates all of its representations at once.
+
+Entries are stored with the tags of the entities they were built from,
+e.g. "product:3" for a product embedded in the entry, or "products" for
+entries listing all products. Writes invalidate the tags of the entities
+they change, which deletes exactly the entries depending on them. The tag
+index is kept in the cache itself under "tag:<tag>" keys, so it is shared
+by all workers using a shared backend.
+
+When an entry is missing, only one request per representation rebuilds it
+at a time, the others wait for its result instead of all querying the db.
+
+With CACHE_STALE_WHILE_REVALIDATE set, invalidating an entry marks its
+representations stale instead of deleting them. A stale representation of
+a resource that can be revalidated is still served for up to
+CACHE_MAX_STALENESS seconds while a background thread rebuilds it.
+
+Collection entries can also be patched in place by writes, see patch_entry,
+so that they survive steady write traffic.
+
+Every tag has a generation, kept under "gen:<tag>", which is set to the
+number of the write invalidating it, taken from a sequence shared by all
+tags. The ETag of a representation is derived from the generations of its
+tags, and a request whose If-None-Match matches the cached representation
+is answered with 304 straight from the cache. The sequence is read when a
+request starts reading the db, so a response is not cached if a write was
+committed while it was built, as it may be missing from the body.
+
+The tag index and the generations are kept in the same cache as the
+entries and may be evicted before them, in which case a write cannot find
+the entries depending on it. Every hit therefore checks that the
+generations of the representation's tags are unchanged, and treats it as
+a miss otherwise.
+"""
+import hashlib
+import queue
+import threading
+import time
+from urllib.parse import urlencode
+from flask import Response, request, g, current_app, has_request_context
+from flask_caching import Cache
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from productsapi.encoding import dumps, loads
+
+# The cache backend is configured through the app config in create_app
+cache = Cache()
+
+# Representations kept per entry, the oldest ones are dropped first
+MAX_REPRESENTATIONS = 32
+
+# The number of the last write, see bump
+SEQUENCE_KEY = "gen:*"
+
+# Query parameters selecting a representation. The resources ignore the
+# others, so they are left out of the key and cannot be used to fill the
+# entries up and evict the representations in use.
+REPRESENTATION_PARAMS = ("after", "fields", "limit", "max_price", "min_price", "order", "sort")
+
+
+def representation_args(args):
+    """
+    Returns the parameters of args selecting a representation as a list of
+    name and value pairs sorted by name, with the fields sorted as well.
+    Links to other representations are built with it too, so that a body
+    does not depend on the order of the parameters it was requested with.
+    """
+    canonical = []
+    for name in REPRESENTATION_PARAMS:
+        if name in args:
+            value = args[name]
+            if name == "fields":
+                value = ",".join(sorted({field for field in value.split(",") if field}))
+            canonical.append((name, value))
+    return canonical
+
+
+def representation_key():
+    """
+    Returns the key of the representation requested by the current request,
+    its path with the canonical query parameters. The key is also the path
+    the representation is rebuilt from.
+    """
+    return request.path + "?" + urlencode(representation_args(request.args))
+
+
+class SingleFlight:
+    """
+    Coalesces the rebuilds of missing cache entries. The first request
+    missing a representation rebuilds it, the requests missing it meanwhile
+    wait for the rebuild and are served its result. Requests of one process
+    wait on an event, other processes sharing the cache are kept out with a
+    lock entry in the cache. Waiting is given up after timeout seconds, so a
+    stuck rebuild only slows the requests down.
+    """
+
+    # How often a rebuild in another process is checked for being done
+    poll_interval = 0.05
+
+    def __init__(self, timeout=5):
+        self.timeout = timeout
+        self.flights = {}
+        self.rebuilds = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self.lock = threading.Lock()
+
+    def begin(self, key):
+        """
+        Returns True after waiting for another request rebuilding the key.
+        Otherwise returns False and the caller rebuilds it, the rebuild is
+        ended by end or at the latest when the request is torn down.
+        """
+        with self.lock:
+            event = self.flights.get(key)
+            if event is None:
+                self.flights[key] = threading.Event()
+        if event is not None:
+            if not event.wait(self.timeout):
+                self.count("timeouts")
+            return True
+        lock_key = "rebuild:" + key
+        locked = cache.add(lock_key, True, timeout=self.timeout)
+        g.setdefault("rebuilding", {})[key] = locked
+        if locked:
+            return False
+        deadline = time.monotonic() + self.timeout
+        while cache.has(lock_key):
+            if time.monotonic() > deadline:
+                self.count("timeouts")
+                break
+            time.sleep(self.poll_interval)
+        return True
+
+    def end(self, key):
+        """
+        Ends the rebuild of the key started by the current request and wakes
+        up the requests waiting for it.
+        """
+        locked = g.get("rebuilding", {}).pop(key, None)
+        if locked is None:
+            return
+        if locked:
+            cache.delete("rebuild:" + key)
+        with self.lock:
+            event = self.flights.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def count(self, counter):
+        """
+        Increments one of the counters.
+        """
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+class Revalidator:
+    """
+    Rebuilds stale representations in a background thread, one at a time.
+    A representation is queued at most once until it has been rebuilt.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.queue = queue.Queue()
+        self.pending = set()
+        self.revalidations = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def schedule(self, name, render):
+        """
+        Queues the rebuild of the current request's representation of the
+        entry. render is called in a request context for the same path and
+        returns the response and the tags to cache it with.
+        """
+        key = flight_key(name)
+        with self.lock:
+            if key in self.pending:
+                return
+            self.pending.add(key)
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name="cache-revalidator", daemon=True)
+                self.thread.start()
+        self.queue.put((key, name, representation_key(), render))
+
+    def _run(self):
+        while True:
+            key, name, path, render = self.queue.get()
+            try:
+                with self.app.test_request_context(path):
+                    cache_response(name, *render())
+                self.revalidations += 1
+            except Exception:
+                self.failures += 1
+                self.app.logger.exception("Revalidating %s failed", path)
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
+                self.queue.task_done()
+
+
+def init_response_cache(app):
+    """
+    This function attaches the rebuild coalescing and the revalidator to the
+    app. Requests wait at most CACHE_REBUILD_TIMEOUT seconds for another
+    request's rebuild.
+    """
+    flights = app.extensions["single_flight"] = SingleFlight(
+        timeout=app.config["CACHE_REBUILD_TIMEOUT"])
+    app.extensions["revalidator"] = Revalidator(app)
+
+    @app.teardown_request
+    def end_rebuilds(exc):
+        # Rebuilds that failed or did not cache their response
+        for key in list(g.get("rebuilding", {})):
+            flights.end(key)
+        g.pop("generation_snapshot", None)
+
+
+def flight_key(name):
+    """
+    Returns the key the rebuild of the current request's representation of
+    the entry is coalesced on.
+    """
+    return name + " " + representation_key()
+
+
+def cached_response(name, revalidate=None):
+    """
+    Returns the cached response of the entry for the current request, or
+    None if it is not cached, in which case the caller is expected to
+    rebuild it. If another request is already rebuilding it, the result of
+    that rebuild is returned instead. revalidate is the function rebuilding
+    the response in the background, see Revalidator.schedule. Without it
+    stale representations are never served.
+    """
+    response = _cached_response(name, revalidate)
+    if response is not None:
+        return response
+    flights = current_app.extensions["single_flight"]
+    waited = flights.begin(flight_key(name))
+    # The entry may have been stored between the miss and begin
+    response = _cached_response(name, revalidate)
+    if response is not None:
+        if waited:
+            flights.count("coalesced")
+        else:
+            flights.end(flight_key(name))
+        return response
+    if not waited:
+        flights.count("rebuilds")
+    return None
+
+
+def _cached_response(name, revalidate):
+    entry = cache.get(name)
+    if not entry:
+        return None
+    representation = entry.get(representation_key())
+    if representation is None:
+        return None
+    body, etag, mimetype, stale_since, versions = representation
+    if stale_since is None and generations(list(versions)) != versions:
+        # Written since, but the tag index lost track of the entry
+        return None
+    if stale_since is not None:
+        if revalidate is None or \
+                time.time() - stale_since > current_app.config["CACHE_MAX_STALENESS"]:
+            return None
+        current_app.extensions["revalidator"].schedule(name, revalidate)
+    response = Response(body, 200, mimetype=mimetype)
+    response.set_etag(etag)
+    return conditional(response)
+
+
+def conditional(response):
+    """
+    Turns the response into a 304 if the request already has it. Clients
+    are told to revalidate their copy on every use, so that polling clients
+    such as browsers send If-None-Match.
+    """
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def sequence():
+    """
+    Returns the number of the last write. A missing sequence, e.g. because
+    it was evicted, starts at the current time in nanoseconds, so that it
+    never goes back to a number it had before.
+    """
+    value = cache.get(SEQUENCE_KEY)
+    if value is None:
+        cache.add(SEQUENCE_KEY, time.time_ns())
+        value = cache.get(SEQUENCE_KEY)
+    return value
+
+
+@event.listens_for(Session, "after_begin")
+def take_snapshot(session, transaction, connection):
+    """
+    This function remembers the number of the last write when the request
+    starts reading the db, before the first statement runs. Generations
+    newer than it belong to writes the request may not have seen.
+    """
+    if has_request_context() and "single_flight" in current_app.extensions \
+            and "generation_snapshot" not in g:
+        g.generation_snapshot = sequence()
+
+
+def generations(tags):
+    """
+    Returns the current generations of the tags. A tag without a generation,
+    e.g. because it was evicted, starts at the number of the last write, so
+    that it never repeats a generation it had before.
+    """
+    keys = ["gen:" + tag for tag in tags]
+    values = cache.get_many(*keys)
+    for index, value in enumerate(values):
+        if value is None:
+            cache.add(keys[index], sequence())
+            values[index] = cache.get(keys[index])
+    return dict(zip(tags, values))
+
+
+def entity_tag(key, versions):
+    """
+    Returns the ETag of a representation built from the tagged entities,
+    given the generations of their tags. It changes whenever any of the
+    tags is invalidated.
+    """
+    state = key + "".join(f" {tag}={versions[tag]}" for tag in sorted(versions))
+    return hashlib.md5(state.encode()).hexdigest()
+
+
+def bump(*tags):
+    """
+    Sets the generations of the tags to the number of a new write.
+    """
+    if not tags:
+        return
+    cache.add(SEQUENCE_KEY, time.time_ns())
+    number = cache.cache.inc(SEQUENCE_KEY)
+    cache.set_many({"gen:" + tag: number for tag in set(tags)})
+
+
+def cache_response(name, response, tags=()):
+    """
+    Stores the body of the response as the current request's representation
+    of the entry, records the entry under each of the given tags and
+    returns the response with its ETag set. The response is turned into a
+    304 if the request already has the representation.
+    """
+    body = response.get_data()
+    key = representation_key()
+    tags = sorted(set(tags))
+    versions = generations(tags)
+    snapshot = g.get("generation_snapshot")
+    if snapshot is not None and any(version > snapshot for version in versions.values()):
+        # Written while the response was built, the body may predate the
+        # write, so it is neither cached nor given an ETag
+        current_app.extensions["single_flight"].end(flight_key(name))
+        return conditional(response)
+    # None of the tags changed since the snapshot, so these are the
+    # generations the body was built from
+    etag = entity_tag(key, versions)
+    entry = cache.get(name) or {}
+    entry[key] = (body, etag, response.mimetype, None, versions)
+    while len(entry) > MAX_REPRESENTATIONS:
+        del entry[next(iter(entry))]
+    cache.set(name, entry)
+    record(name, tags)
+    current_app.extensions["single_flight"].end(flight_key(name))
+    response.set_etag(etag)
+    return conditional(response)
+
+
+def record(name, tags):
+    """
+    Records the entry under each of the tags.
+    """
+    for tag in set(tags):
+        tag_key = "tag:" + tag
+        names = cache.get(tag_key) or set()
+        if name not in names:
+            names.add(name)
+            cache.set(tag_key, names)
+
+
+def patch_entry(name, patch, tags=()):
+    """
+    Applies a change to every cached representation of the entry in place.
+    patch is called with the decoded document and the representation key.
+    It changes the document and returns True, returns False if the
+    representation is not affected, or None if the change cannot be applied
+    to it, in which case the representation is invalidated. Patch entries
+    after invalidating the tags of the change, so that the ETags of the
+    patched representations are derived from the new generations. tags are
+    the tags of entities the patch adds to the representations.
+    """
+    entry = cache.get(name)
+    if not entry:
+        return
+    stale = current_app.config["CACHE_STALE_WHILE_REVALIDATE"]
+    for key, (body, etag, mimetype, stale_since, versions) in list(entry.items()):
+        document = loads(body)
+        patched = patch(document, key)
+        if patched is None and stale:
+            entry[key] = (body, etag, mimetype, stale_since or time.time(), versions)
+        elif patched is None:
+            del entry[key]
+        elif patched:
+            body = dumps(document)
+            versions = generations(sorted(set(versions) | set(tags)))
+            entry[key] = (body, entity_tag(key, versions), mimetype, stale_since, versions)
+        else:
+            # Not affected by the write, so it is as current as before it
+            entry[key] = (body, etag, mimetype, stale_since, generations(list(versions)))
+    if entry:
+        cache.set(name, entry)
+        record(name, tags)
+    else:
+        cache.delete(name)
+
+
+def invalidate(*tags, keep=()):
+    """
+    Bumps the generations of the tags and deletes every cache entry recorded
+    under any of them, or marks their representations stale in
+    stale-while-revalidate mode. Entries named in keep, e.g. because they
+    are patched, stay recorded under the tags and are left alone.
+    """
+    bump(*tags)
+    names = set()
+    for tag in set(tags):
+        tag_key = "tag:" + tag
+        tagged = cache.get(tag_key) or set()
+        names |= tagged
+        if tagged & set(keep):
+            cache.set(tag_key, tagged & set(keep))
+        else:
+            cache.delete(tag_key)
+    names -= set(keep)
+    if not current_app.config["CACHE_STALE_WHILE_REVALIDATE"]:
+        for name in names:
+            cache.delete(name)
+        return
+    now = time.time()
+    for name in names:
+        entry = cache.get(name)
+        if not entry:
+            continue
+        for key, (body, etag, mimetype, stale_since, versions) in entry.items():
+            entry[key] = (body, etag, mimetype, stale_since or now, versions)
+        cache.set(name, entry)
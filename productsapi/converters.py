@@ -2,33 +2,162 @@
 Converters are in their own file since they're mapped to app.url_map config
 And it seemed more logical to do the mapping in app.py
 Than cross-import app here
+
+The names in URLs are resolved to primary keys through a NameKeyCache, so
+matching a URL usually does not query the db.
 """
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
 from werkzeug.routing import BaseConverter
 from werkzeug.exceptions import NotFound
-from productsapi.db import User, Category
+from productsapi.db import db, User, Category
+
+# Returned by NameKeyCache.get for names it holds nothing about
+MISSING = object()
+
+
+class NameKeyCache:
+    """
+    Bounded LRU mapping the names of users and categories used in URLs to
+    their primary keys. Unknown names are remembered as None, so floods of
+    requests for bogus names are answered with 404 without querying the db.
+    Writes of this process forget the names they change, changes made by
+    other workers are seen once entries expire after ttl seconds, or
+    negative_ttl seconds for unknown names.
+    """
+
+    def __init__(self, max_size=1024, ttl=60, negative_ttl=5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, model, name):
+        """
+        Returns the primary key of the named row, None if there is no such
+        row or MISSING if the name is not cached.
+        """
+        key = (model.__name__, name)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return MISSING
+
+    def put(self, model, name, pk):
+        """
+        Stores the primary key of the named row, or None for an unknown name,
+        evicting the least recently used entry when the cache is full.
+        """
+        ttl = self.ttl if pk is not None else self.negative_ttl
+        with self.lock:
+            self.entries[(model.__name__, name)] = (pk, time.monotonic() + ttl)
+            self.entries.move_to_end((model.__name__, name))
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def forget(self, model, *names):
+        """
+        Forgets the names, e.g. when a row is created, renamed or deleted.
+        """
+        with self.lock:
+            for name in names:
+                self.entries.pop((model.__name__, name), None)
+
+    def clear(self):
+        """
+        Forgets all names.
+        """
+        with self.lock:
+            self.entries.clear()
+
+
+def forget_names(model, *names):
+    """
+    This function makes the URL converters look the names up again, call it
+    after writes creating, renaming or deleting users or categories.
+    """
+    current_app.extensions["name_keys"].forget(model, *names)
+
+
+def forget_all_names():
+    """
+    This function makes the URL converters look all names up again, call it
+    when a cached primary key turns out to belong to a row deleted by
+    another worker.
+    """
+    current_app.extensions["name_keys"].clear()
+
+
+def resolve(model, name):
+    """
+    This function returns the row of the model with the name, raising
+    NotFound if there is none. A cached primary key is turned into the
+    instance already in the request's session, or else into an instance
+    whose columns are loaded when first accessed, so routing does not query
+    the db and e.g. cache hits keyed by the id never do. Loading the columns
+    of a row deleted by another worker raises ObjectDeletedError, which the
+    api answers with 404.
+    """
+    keys = current_app.extensions["name_keys"]
+    pk = keys.get(model, name)
+    if pk is MISSING:
+        row = model.query.filter_by(name=name).first()
+        keys.put(model, name, row.id if row is not None else None)
+        if row is None:
+            raise NotFound
+        return row
+    if pk is None:
+        raise NotFound
+    instance = db.session.identity_map.get(identity_key(model, pk))
+    if instance is None:
+        instance = model(id=pk)
+        make_transient_to_detached(instance)
+        db.session.add(instance)
+    return instance
+
+
+def init_name_keys(app):
+    """
+    This function attaches the name to primary key cache of the URL
+    converters to the app, holding NAME_KEY_CACHE_SIZE names for
+    NAME_KEY_CACHE_TTL seconds, or NAME_KEY_NEGATIVE_TTL seconds for
+    unknown names.
+    """
+    app.extensions["name_keys"] = NameKeyCache(
+        max_size=app.config["NAME_KEY_CACHE_SIZE"],
+        ttl=app.config["NAME_KEY_CACHE_TTL"],
+        negative_ttl=app.config["NAME_KEY_NEGATIVE_TTL"]
+    )
+
 
 class UserConverter(BaseConverter):
     """
     This class converts the user from or to url.
     """
     def to_python(self, value):
-        db_user = User.query.filter_by(name=value).first()
-        if db_user is None:
-            raise NotFound
-        return db_user
+        return resolve(User, value)
     def to_url(self, db_user):
-        return db_user.name
+        return super().to_url(db_user if isinstance(db_user, str) else db_user.name)
 
 class CategoryConverter(BaseConverter):
     """
     This class converts the category from or to url.
     """
     def to_python(self, value):
-        db_category = Category.query.filter_by(name=value).first()
-        if db_category is None:
-            raise NotFound
-        return db_category
+        return resolve(Category, value)
     def to_url(self, db_category):
-        return db_category.name
-
-
+        return super().to_url(
+            db_category if isinstance(db_category, str) else db_category.name)
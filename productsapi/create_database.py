@@ -50,14 +50,14 @@ db.session.commit()
 # Add random products
 product1 = Product(name="Fender Stratocaster",
                    description="A brand new Fender Stratocaster Deluxe Edition. Made in USA.",
-                   price=1999.99, user_name=user1.name, categories=[category1])
+                   price=1999.99, user=user1, categories=[category1])
 product2 = Product(name="Lenovo Thinkpad t420", description="A refurbished business model laptop.",
-                   price=149.99, user_name=user1.name, categories=[category2])
+                   price=149.99, user=user1, categories=[category2])
 product3 = Product(name="SAMSUNG 980 SSD 1TB PCle 3.0x4, NVMe M.2 2280",
                    description="UPGRADE TO NVMe SPEED Whether you need a boost for gaming" \
                                "or a seamless workflow for heavy graphics, the 980 is a smart choice.",
-                   price=69.99, user_name=user3.name, categories=[category2])
-product4 = Product(name="1984", description="A book by George Orwell", price=29.99, user_name=user3.name,
+                   price=69.99, user=user3, categories=[category2])
+product4 = Product(name="1984", description="A book by George Orwell", price=29.99, user=user3,
                    categories=[category3])
 db.session.add(product1)
 db.session.add(product2)
@@ -79,12 +79,12 @@ db.session.commit()
 # db.session.add(product_category3)
 
 # Add random reviews
-review1 = Review(rating=4.9, description="An amazing guitar!!", user_name=user2.name,
-                 product_name=product1.name)
+review1 = Review(rating=4.9, description="An amazing guitar!!", user=user2,
+                 product=product1)
 review2 = Review(rating=0.5, description="Bad laptop, can't run Fortnite with 300 fps.",
-                 user_name=user2.name, product_name=product2.name)
+                 user=user2, product=product2)
 review3 = Review(rating=4.4, description="Almost the perfect laptop! Thinkpads rock!",
-                 user_name=user3.name, product_name=product2.name)
+                 user=user3, product=product2)
 db.session.add(review1)
 db.session.add(review2)
 db.session.add(review3)
@@ -92,6 +92,9 @@ db.session.add(review3)
 # Commit the changes
 db.session.commit()
 
+# The reviews were added without the API, so compute the rating aggregates
+Product.rebuild_ratings()
+
 # Pop the application context
 app_ctx.pop()
 
@@ -3,7 +3,17 @@ This module contains the db structure and parameters.
 """
 import enum
 import json
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+import click
+from flask import current_app
+from flask.cli import with_appcontext
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateColumn, CreateTable
 import jwt
 import datetime
 import os
@@ -11,16 +21,44 @@ from dotenv import load_dotenv
 
 load_dotenv()
 db = SQLAlchemy()
+SECRET_KEY = os.getenv("SECRET_KEY")
 
 # Create table for many-to-many relationship between categories and products
+# The primary key indexes the categories of a product, the second index the
+# products of a category.
 Product_categories = db.Table("product_categories",
                               db.Column("product_id", db.Integer, db.ForeignKey(
                                   "product.id"), primary_key=True),
                               db.Column("category_id", db.Integer, db.ForeignKey(
-                                  "category.id"), primary_key=True)
+                                  "category.id"), primary_key=True),
+                              db.Index("ix_product_categories_category_id_product_id",
+                                       "category_id", "product_id")
                               )
 
 
+# Histogram of a product without reviews, keyed by whole stars
+EMPTY_HISTOGRAM = json.dumps({str(star): 0 for star in range(1, 11)})
+
+
+def wanted(field, fields):
+    """
+    This function tells whether a field is included in a sparse fieldset,
+    None meaning all fields.
+    """
+    return fields is None or field in fields
+
+
+def only_fields(document, fields):
+    """
+    This function returns the document with only the given fields, or as is
+    if fields is None. Mason keys such as @controls are always kept.
+    """
+    if fields is None:
+        return document
+    return {key: value for key, value in document.items()
+            if key in fields or key.startswith("@")}
+
+
 class RoleType(str, enum.Enum):
     """
     This class defines the three possible roles
@@ -50,12 +88,166 @@ class BlacklistToken(db.Model):
     @staticmethod
     def check_blacklist(auth_token):
         # check whether auth token has been blacklisted
-        res = BlacklistToken.query.filter_by(token=str(auth_token)).first()
-        if res:
-            return True  
-        else:
-            return False
-    
+        return current_app.extensions["blacklist_index"].contains(str(auth_token))
+
+
+class BlacklistIndex:
+    """
+    In-process index of the blacklisted tokens, keyed by the token's digest,
+    that answers blacklist checks without querying blacklist_tokens. The
+    index is loaded on first use and then only fetches rows added since the
+    last sync, at most once every sync_interval seconds, so logouts done by
+    other workers are seen after that delay. Rows of tokens whose exp has
+    passed are deleted every prune_interval seconds, since expired tokens
+    are rejected before the blacklist is checked.
+    """
+
+    def __init__(self, sync_interval=5, prune_interval=3600):
+        self.sync_interval = sync_interval
+        self.prune_interval = prune_interval
+        self.expirations = {}
+        self.last_id = 0
+        self.synced_at = None
+        self.pruned_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def digest(auth_token):
+        """
+        Returns the key the token is stored under in the index.
+        """
+        return hashlib.sha256(auth_token.encode()).digest()
+
+    @staticmethod
+    def expiration(auth_token):
+        """
+        Returns the exp claim of the token, or None if it cannot be read.
+        """
+        try:
+            return jwt.decode(auth_token, options={"verify_signature": False}).get("exp")
+        except jwt.InvalidTokenError:
+            return None
+
+    def add(self, row_id, auth_token):
+        """
+        Adds a blacklisted token to the index. Rows added here are fetched
+        again by the next sync, which is harmless, since the sync cursor is
+        only moved by the sync itself and must not skip rows inserted by
+        other workers in the meantime.
+        """
+        self.expirations[self.digest(auth_token)] = (row_id, self.expiration(auth_token))
+
+    def contains(self, auth_token):
+        """
+        Tells whether the token is blacklisted.
+        """
+        now = time.monotonic()
+        if self.synced_at is None or now - self.synced_at > self.sync_interval:
+            self.sync(now)
+        return self.digest(auth_token) in self.expirations
+
+    def sync(self, now):
+        """
+        Loads the blacklist rows added since the last sync and prunes the
+        expired ones when the prune interval has passed.
+        """
+        with self.lock:
+            rows = db.session.query(BlacklistToken.id, BlacklistToken.token).filter(
+                BlacklistToken.id > self.last_id).all()
+            for row_id, auth_token in rows:
+                self.add(row_id, auth_token)
+                self.last_id = max(self.last_id, row_id)
+            self.synced_at = now
+            if now - self.pruned_at > self.prune_interval:
+                self.prune()
+                self.pruned_at = now
+
+    def prune(self):
+        """
+        Drops the tokens whose exp has passed from the index and deletes
+        their rows in a transaction of its own.
+        """
+        now = time.time()
+        expired = [
+            digest for digest, (_, exp) in self.expirations.items()
+            if exp is not None and exp < now
+        ]
+        if not expired:
+            return
+        expired_ids = [self.expirations.pop(digest)[0] for digest in expired]
+        with db.engine.begin() as connection:
+            connection.execute(BlacklistToken.__table__.delete().where(
+                BlacklistToken.id.in_(expired_ids)))
+
+
+class TokenCache:
+    """
+    Bounded LRU of tokens whose signature has already been verified, keyed
+    by the token's digest and holding the token's subject and exp. A hit
+    skips signature verification until the token expires or is discarded
+    on logout. The blacklist is still checked on every hit.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, auth_token):
+        """
+        Returns the subject of a verified, unexpired token or None.
+        """
+        digest = BlacklistIndex.digest(auth_token)
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is not None and entry[1] > time.time():
+                self.entries.move_to_end(digest)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self.entries[digest]
+            self.misses += 1
+            return None
+
+    def put(self, auth_token, subject, exp):
+        """
+        Stores a verified token, evicting the least recently used one when
+        the cache is full.
+        """
+        with self.lock:
+            self.entries[BlacklistIndex.digest(auth_token)] = (subject, exp)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def discard(self, auth_token):
+        """
+        Forgets a token, e.g. when it is blacklisted.
+        """
+        with self.lock:
+            self.entries.pop(BlacklistIndex.digest(auth_token), None)
+
+
+def init_token_cache(app):
+    """
+    This function attaches a verified-token cache of TOKEN_CACHE_SIZE
+    entries to the app.
+    """
+    app.extensions["token_cache"] = TokenCache(max_size=app.config["TOKEN_CACHE_SIZE"])
+
+
+def init_blacklist_index(app):
+    """
+    This function attaches a blacklist index to the app. BLACKLIST_SYNC_INTERVAL
+    and BLACKLIST_PRUNE_INTERVAL are given in seconds.
+    """
+    app.extensions["blacklist_index"] = BlacklistIndex(
+        sync_interval=app.config["BLACKLIST_SYNC_INTERVAL"],
+        prune_interval=app.config["BLACKLIST_PRUNE_INTERVAL"]
+    )
+
+
 class User(db.Model):
     """
     This class defines the table User and its relationships to other tables.
@@ -84,12 +276,35 @@ class User(db.Model):
             }
             return jwt.encode(
                 payload,
-                os.getenv("SECRET_KEY"),
+                SECRET_KEY,
                 algorithm='HS256'
             )
         except Exception as e:
             return e
 
+    @staticmethod
+    def verify_auth_token(auth_token):
+        """
+        Verifies the auth token
+        :param auth_token:
+        :return: tuple of the token's subject and None, or None and an error message
+        """
+        token_cache = current_app.extensions["token_cache"]
+        subject = token_cache.get(auth_token)
+        if subject is None:
+            try:
+                payload = jwt.decode(auth_token, SECRET_KEY, algorithms=["HS256"])
+            except jwt.ExpiredSignatureError:
+                return None, 'Signature expired. Please log in again.'
+            except jwt.InvalidTokenError:
+                return None, 'Invalid token. Please log in again.'
+            subject = payload['sub']
+            if 'exp' in payload:
+                token_cache.put(auth_token, subject, payload['exp'])
+        if BlacklistToken.check_blacklist(auth_token):
+            return None, 'Token blacklisted. Please log in again.'
+        return subject, None
+
     @staticmethod
     def decode_auth_token(auth_token):
         """
@@ -97,18 +312,8 @@ class User(db.Model):
         :param auth_token:
         :return: integer|string
         """
-        try:
-            payload = jwt.decode(auth_token,
-                                 os.getenv("SECRET_KEY"), algorithms=["HS256"])
-            is_blacklisted_token = BlacklistToken.check_blacklist(auth_token)
-            if is_blacklisted_token:
-                return 'Token blacklisted. Please log in again.'
-            else:
-                return payload['sub']
-        except jwt.ExpiredSignatureError:
-            return 'Signature expired. Please log in again.'
-        except jwt.InvalidTokenError:
-            return 'Invalid token. Please log in again.'
+        subject, error = User.verify_auth_token(auth_token)
+        return error if error else subject
 
     @staticmethod
     def json_schema():
@@ -155,10 +360,11 @@ class User(db.Model):
         }
         return schema
 
-    def serialize(self, long=True):
+    def serialize(self, long=True, fields=None):
         """
         This function turns the dictionary to JSON object either
-        in short or long form.
+        in short or long form. If fields is given, only those fields
+        are included.
         """
         serialized_user = {
             'id': self.id,
@@ -169,13 +375,14 @@ class User(db.Model):
             'avatar': self.avatar
         }
 
-        if long:
+        if long and wanted("products", fields):
             serialized_user["products"] = [product.serialize(
                 long=False) for product in self.products]
+        if long and wanted("reviews", fields):
             serialized_user["reviews"] = [review.serialize(
                 include_user=False) for review in self.reviews]
 
-        return serialized_user
+        return only_fields(serialized_user, fields)
 
     def deserialize(self, doc):
         """
@@ -198,14 +405,24 @@ class Review(db.Model):
     description = db.Column(db.String(65535), nullable=True)
     rating = db.Column(db.Float, nullable=False)
 
-    user_name = db.Column(db.String(256), db.ForeignKey(
-        "user.name"), nullable=False)
-    product_name = db.Column(db.String(256), db.ForeignKey(
-        "product.name"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey("product.id"), nullable=False)
+    # The names are read from the referenced rows, see also product_name
+    # below Product. They are set through user and product.
+    user_name = db.column_property(
+        db.select(User.name).where(User.id == user_id)
+        .correlate_except(User).scalar_subquery())
 
     user = db.relationship("User", back_populates="reviews")
     product = db.relationship("Product", back_populates="reviews")
 
+    # A user reviews a product once. The unique index also serves the
+    # lookups of a user's reviews, the second one those of a product's.
+    __table_args__ = (
+        db.Index("ix_review_user_id_product_id", "user_id", "product_id", unique=True),
+        db.Index("ix_review_product_id", "product_id"),
+    )
+
     @staticmethod
     def json_schema():
         """
@@ -236,10 +453,11 @@ class Review(db.Model):
         }
         return schema
 
-    def serialize(self, include_product=True, include_user=True):
+    def serialize(self, include_product=True, include_user=True, fields=None):
         """
         This function turns the dictionary to JSON object either
-        in short or long form.
+        in short or long form. If fields is given, only those fields
+        are included.
         """
         serialized_review = {
             'id': self.id,
@@ -251,11 +469,11 @@ class Review(db.Model):
         if include_product or include_user:
             serialized_review.pop("product_name")
             serialized_review.pop("user_name")
-        if include_user:
+        if include_user and wanted("user", fields):
             serialized_review['user'] = self.user.serialize(long=False)
-        if include_product:
+        if include_product and wanted("product", fields):
             serialized_review['product'] = self.product.serialize(long=False)
-        return serialized_review
+        return only_fields(serialized_review, fields)
 
     def deserialize(self, doc):
         """
@@ -264,8 +482,6 @@ class Review(db.Model):
         self.id = doc['id'] if 'id' in doc else self.id
         self.rating = doc['rating'] if 'rating' in doc else self.rating
         self.description = doc['description'] if 'description' in doc else self.description
-        self.user_name = doc['user_name'] if 'user_name' in doc else self.user_name
-        self.product_name = doc['product_name'] if 'product_name' in doc else self.product_name
 
 
 class Product(db.Model):
@@ -278,14 +494,110 @@ class Product(db.Model):
     price = db.Column(db.Float, nullable=False)
     description = db.Column(db.String(65535), nullable=True)
     images = db.Column(db.String(65535), nullable=True)
-    user_name = db.Column(db.String(256), db.ForeignKey(
-        "user.name"), nullable=False)
-    #user_name = db.Column(db.String(256), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False, index=True)
+    # The seller's name, read from the user row and set through user
+    user_name = db.column_property(
+        db.select(User.name).where(User.id == user_id)
+        .correlate_except(User).scalar_subquery())
+
+    # Aggregates of the ratings of the product's reviews, kept up to date
+    # by the review writes with add_rating, so that the rating summary is
+    # read from the product row. rebuild_ratings recomputes them.
+    review_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_sum = db.Column(db.Float, nullable=False, default=0, server_default="0")
+    rating_sum_squares = db.Column(db.Float, nullable=False, default=0, server_default="0")
+    rating_histogram = db.Column(db.String(256), nullable=False,
+                                 default=EMPTY_HISTOGRAM, server_default=EMPTY_HISTOGRAM)
+    # The average rating, or 0 without reviews, stored so that listings can
+    # be sorted by rating with an index
+    rating_average = db.Column(db.Float, nullable=False, default=0, server_default="0")
+
+    # Listings sorted or filtered by price or sorted by rating are index
+    # scans, the id breaks ties for keyset pagination
+    __table_args__ = (
+        db.Index("ix_product_price_id", "price", "id"),
+        db.Index("ix_product_rating_average_id", "rating_average", "id"),
+    )
 
     user = db.relationship("User", back_populates="products")
+    # Categories are serialized with nearly every product, so they are
+    # loaded with one batched IN query for all loaded products instead of
+    # one lazy query per product. Listings only carry the rating summary of
+    # the reviews, so reviews are loaded when accessed.
     reviews = db.relationship("Review", back_populates="product")
     categories = db.relationship(
-        "Category", secondary=Product_categories, back_populates="products")
+        "Category", secondary=Product_categories, back_populates="products",
+        lazy="selectin")
+
+    @staticmethod
+    def add_rating(product_id, rating, delta=1):
+        """
+        Adds a rating to the aggregates of the product, or removes it with
+        a delta of -1. The histogram counts ratings by whole stars. The
+        aggregates are updated in one UPDATE statement of the current
+        transaction, so concurrent review writes do not lose each other's
+        updates.
+        """
+        star = '$."%d"' % min(max(int(rating), 1), 10)
+        Product.query.filter_by(id=product_id).update({
+            Product.review_count: Product.review_count + delta,
+            Product.rating_sum: Product.rating_sum + delta * rating,
+            Product.rating_sum_squares: Product.rating_sum_squares + delta * rating * rating,
+            Product.rating_average: db.func.coalesce(
+                (Product.rating_sum + delta * rating) /
+                db.func.nullif(Product.review_count + delta, 0), 0),
+            Product.rating_histogram: db.func.json_set(
+                Product.rating_histogram, star,
+                db.func.json_extract(Product.rating_histogram, star) + delta),
+        }, synchronize_session=False)
+
+    @staticmethod
+    def rebuild_ratings():
+        """
+        Recomputes the rating aggregates of every product from its reviews,
+        e.g. to backfill them in an existing db.
+        """
+        star = db.cast(Review.rating, db.Integer)
+        rows = db.session.query(
+            Review.product_id, star, db.func.count(),
+            db.func.sum(Review.rating), db.func.sum(Review.rating * Review.rating)
+        ).group_by(Review.product_id, star)
+        aggregates = {}
+        for product_id, rating, count, total, squares in rows:
+            aggregate = aggregates.setdefault(product_id, {
+                "review_count": 0, "rating_sum": 0, "rating_sum_squares": 0,
+                "rating_histogram": json.loads(EMPTY_HISTOGRAM)})
+            aggregate["review_count"] += count
+            aggregate["rating_sum"] += total
+            aggregate["rating_sum_squares"] += squares
+            aggregate["rating_histogram"][str(min(max(rating, 1), 10))] += count
+        for product in Product.query:
+            aggregate = aggregates.get(product.id, {})
+            product.review_count = aggregate.get("review_count", 0)
+            product.rating_sum = aggregate.get("rating_sum", 0)
+            product.rating_sum_squares = aggregate.get("rating_sum_squares", 0)
+            product.rating_average = product.rating_sum / product.review_count \
+                if product.review_count else 0
+            product.rating_histogram = json.dumps(
+                aggregate["rating_histogram"]) if aggregate else EMPTY_HISTOGRAM
+        db.session.commit()
+
+    def rating_summary(self):
+        """
+        This function returns the review count, average rating, standard
+        deviation and histogram of whole-star ratings of the product.
+        """
+        count = self.review_count
+        average = stddev = None
+        if count:
+            average = self.rating_sum / count
+            stddev = math.sqrt(max(self.rating_sum_squares / count - average ** 2, 0))
+        return {
+            "count": count,
+            "average": average,
+            "stddev": stddev,
+            "histogram": json.loads(self.rating_histogram),
+        }
 
     @staticmethod
     def json_schema():
@@ -350,10 +662,11 @@ class Product(db.Model):
         }
         return schema
 
-    def serialize(self, long=True):
+    def serialize(self, long=True, fields=None):
         """
         This function turns the dictionary to JSON object either
-        in short or long form.
+        in short or long form. If fields is given, only those fields
+        are included.
         """
         serialized_product = {
             'id': self.id,
@@ -362,12 +675,13 @@ class Product(db.Model):
             'description': self.description,
             'images': json.loads(self.images) if self.images else None
         }
-        if long:
+        if long and wanted("categories", fields):
             serialized_product["categories"] = [category.serialize(
                 long=False) for category in self.categories]
+        if long and wanted("reviews", fields):
             serialized_product["reviews"] = [review.serialize(
                 include_product=False) for review in self.reviews]
-        return serialized_product
+        return only_fields(serialized_product, fields)
 
     def deserialize(self, doc):
         """
@@ -379,11 +693,15 @@ class Product(db.Model):
         self.description = doc['description'] if 'description' in doc else self.description
         self.images = json.dumps(
             doc['images']) if 'images' in doc else self.images
-        self.user_name = doc['user_name'] if 'user_name' in doc else self.user_name
         #self.reviews = doc['reviews'] if 'reviews' in doc else self.reviews
         #self.categories = doc['categories'] if 'categories' in doc else self.categories
 
 
+Review.product_name = db.column_property(
+    db.select(Product.name).where(Product.id == Review.product_id)
+    .correlate_except(Product).scalar_subquery())
+
+
 class Category(db.Model):
     """
     In this class the table Category is defined along with its relationships
@@ -435,20 +753,21 @@ class Category(db.Model):
         }
         return schema
 
-    def serialize(self, long=True):
+    def serialize(self, long=True, fields=None):
         """
         This function turns the dictionary to JSON object either
-        in short or long form.
+        in short or long form. If fields is given, only those fields
+        are included.
         """
         serialized_category = {
             'id': self.id,
             'name': self.name,
             'image': self.image,
         }
-        if long:
+        if long and wanted("products", fields):
             serialized_category["products"] = [
                 product.serialize(long=False) for product in self.products]
-        return serialized_category
+        return only_fields(serialized_category, fields)
 
     def deserialize(self, doc):
         """
@@ -457,3 +776,111 @@ class Category(db.Model):
         self.id = doc['id'] if 'id' in doc else self.id
         self.name = doc['name'] if 'name' in doc else self.name
         self.image = doc['image'] if 'image' in doc else self.image
+
+
+def upgrade_table(table):
+    """
+    This function adds the columns and indexes of the table missing from
+    an existing db. New columns need a server default to be added.
+    """
+    existing = {column["name"] for column in db.inspect(db.engine).get_columns(table.name)}
+    for column in table.columns:
+        if column.name not in existing:
+            ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+            db.session.execute(db.text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+    db.session.commit()
+    for index in table.indexes:
+        try:
+            index.create(db.engine, checkfirst=True)
+        except IntegrityError as exc:
+            raise click.ClickException(
+                f"Could not create {index.name}, remove the duplicate rows first: {exc.orig}"
+            ) from exc
+
+
+# The tables that referenced users and products by name before the integer
+# keys, with the joins resolving each name column to its key
+NAME_KEYS = {
+    "product": {"user_id": ("user_name", "user")},
+    "review": {"user_id": ("user_name", "user"), "product_id": ("product_name", "product")},
+}
+
+
+def migrate_name_keys():
+    """
+    This function moves the products and reviews of a db created before the
+    integer keys from the user_name and product_name columns to user_id and
+    product_id. SQLite cannot change the columns of a table, so each table
+    is recreated and its rows copied over, dropping rows whose names do not
+    resolve. Returns the number of rows dropped, or None if the db needs no
+    migration.
+    """
+    inspector = db.inspect(db.engine)
+    tables = inspector.get_table_names()
+    if not any(name in tables and "user_id" not in
+               {column["name"] for column in inspector.get_columns(name)}
+               for name in NAME_KEYS):
+        return None
+    metadata = db.MetaData()
+    for table in db.metadata.sorted_tables:
+        table.to_metadata(metadata)
+    dropped = 0
+    with db.engine.connect() as connection:
+        # The tables are swapped while other tables still reference them
+        connection.exec_driver_sql("PRAGMA foreign_keys=OFF")
+        for name, keys in NAME_KEYS.items():
+            old_columns = {column["name"] for column in inspector.get_columns(name)}
+            table = metadata.tables[name].to_metadata(metadata, name=name + "_new")
+            connection.execute(CreateTable(table))
+            copied = [column.name for column in table.columns
+                      if column.name in old_columns and column.name not in keys]
+            selected = [f"{name}.{column}" for column in copied]
+            joins = []
+            for key, (name_column, referenced) in keys.items():
+                selected.append(f"{key}_ref.id")
+                joins.append(f'JOIN "{referenced}" AS {key}_ref '
+                             f"ON {key}_ref.name = {name}.{name_column}")
+            connection.exec_driver_sql(
+                f"INSERT INTO {name}_new ({', '.join(copied + list(keys))}) "
+                f"SELECT {', '.join(selected)} FROM {name} {' '.join(joins)}")
+            dropped += connection.exec_driver_sql(f"SELECT count(*) FROM {name}").scalar() - \
+                connection.exec_driver_sql(f"SELECT count(*) FROM {name}_new").scalar()
+            connection.exec_driver_sql(f"DROP TABLE {name}")
+            connection.exec_driver_sql(f"ALTER TABLE {name}_new RENAME TO {name}")
+        connection.exec_driver_sql(
+            "DELETE FROM product_categories WHERE product_id NOT IN (SELECT id FROM product)")
+        connection.commit()
+        connection.exec_driver_sql("PRAGMA foreign_keys=ON")
+    return dropped
+
+
+@click.command("upgrade-db")
+@with_appcontext
+def upgrade_db_command():
+    """
+    Brings an existing db up to date with the models by moving name keys to
+    integer keys, creating the missing tables and adding the missing columns
+    and indexes.
+    """
+    dropped = migrate_name_keys()
+    if dropped is not None:
+        click.echo(f"Moved products and reviews to integer keys, dropped {dropped} "
+                   "rows referencing missing users or products.")
+    db.create_all()
+    for table in db.metadata.sorted_tables:
+        upgrade_table(table)
+    if dropped is not None:
+        Product.rebuild_ratings()
+    click.echo("Upgraded {} tables.".format(len(db.metadata.sorted_tables)))
+
+
+@click.command("rebuild-ratings")
+@with_appcontext
+def rebuild_ratings_command():
+    """
+    Adds the rating aggregate columns and indexes to an existing db and
+    recomputes the aggregates from the reviews.
+    """
+    upgrade_table(Product.__table__)
+    Product.rebuild_ratings()
+    click.echo("Rebuilt the rating aggregates of {} products.".format(Product.query.count()))
@@ -0,0 +1,69 @@
+"""
+In this module, the documents of the API are encoded to the bytes of the
+response bodies. The encoder is chosen with the JSON_ENCODER config: orjson
+if it is installed, or else the json module of the standard library. Both
+write compact UTF-8 and encode enums like RoleType by their value and dates
+and datetimes in ISO 8601, so they produce the same bodies.
+"""
+import datetime
+import enum
+import json
+from flask import current_app
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default(obj):
+    """
+    This function encodes the values the json module cannot encode itself.
+    """
+    if isinstance(obj, enum.Enum):
+        return obj.value
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def json_dumps(obj):
+    """
+    This function encodes the document with the json module.
+    """
+    return json.dumps(obj, default=default, ensure_ascii=False,
+                      separators=(",", ":")).encode()
+
+
+def orjson_dumps(obj):
+    """
+    This function encodes the document with orjson, which encodes enums and
+    datetimes natively.
+    """
+    return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+
+
+ENCODERS = {"json": json_dumps}
+if orjson is not None:
+    ENCODERS["orjson"] = orjson_dumps
+
+# Used where there is no app, e.g. for the bodies built at import
+dumps_default = ENCODERS["orjson" if orjson is not None else "json"]
+loads = orjson.loads if orjson is not None else json.loads
+
+
+def init_json_encoder(app):
+    """
+    This function attaches the encoder named by JSON_ENCODER to the app,
+    "auto" picks orjson when it is installed.
+    """
+    name = app.config["JSON_ENCODER"]
+    app.extensions["json_encoder"] = dumps_default if name == "auto" else ENCODERS[name]
+
+
+def dumps(obj):
+    """
+    This function encodes the document to the bytes of a response body with
+    the encoder of the app.
+    """
+    return current_app.extensions["json_encoder"](obj)
@@ -0,0 +1,105 @@
+"""
+In this module, the SQL statements executed while serving a request are
+counted and timed. The totals are sent back in the Server-Timing header and
+statements repeated suspiciously often in one request are logged, since
+they usually point to an N+1 query.
+"""
+import re
+import time
+from collections import Counter
+from flask import g, request, has_request_context
+from sqlalchemy import event
+
+_WHITESPACE = re.compile(r"\s+")
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+
+def fingerprint(statement):
+    """
+    This function reduces a SQL statement to its shape, so that statements
+    differing only by their parameters or the length of an IN list are
+    counted as the same statement.
+    """
+    statement = _WHITESPACE.sub(" ", statement).strip()
+    statement = _LITERAL.sub("?", statement)
+    return _PLACEHOLDER_LIST.sub("(?)", statement)
+
+
+class QueryStats:
+    """
+    This class holds the number, total duration and fingerprints of the
+    statements executed during one request.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = Counter()
+
+    def record(self, statement, duration):
+        """
+        Adds one executed statement to the totals.
+        """
+        self.count += 1
+        self.duration += duration
+        self.fingerprints[fingerprint(statement)] += 1
+
+    def repeated(self, threshold):
+        """
+        Returns the fingerprints executed more than threshold times.
+        """
+        return {
+            statement: count for statement, count in self.fingerprints.items()
+            if count > threshold
+        }
+
+    def server_timing(self):
+        """
+        Returns the stats formatted as a Server-Timing header value.
+        """
+        return f'db;desc="{self.count} queries";dur={self.duration * 1000:.2f}'
+
+
+# The start time is kept on the execution context, which is dropped with
+# the statement, so statements raising e.g. an IntegrityError leave nothing
+# behind on the pooled connection.
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_start_time = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = context._query_start_time
+    if not has_request_context():
+        return
+    # Created lazily, since the URL converters query the db while the
+    # request is matched, which happens before any before_request hook.
+    if "query_stats" not in g:
+        g.query_stats = QueryStats()
+    g.query_stats.record(statement, time.perf_counter() - started)
+
+
+def init_query_stats(app, engine):
+    """
+    This function hooks the query counter into the engine and the request
+    cycle of the app. Nothing is hooked unless QUERY_STATS_ENABLED is set.
+    QUERY_REPEAT_THRESHOLD sets how many times the same statement may run in
+    one request before it is logged as a possible N+1 query.
+    """
+    if not app.config["QUERY_STATS_ENABLED"]:
+        return
+    threshold = app.config["QUERY_REPEAT_THRESHOLD"]
+
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = g.pop("query_stats", None) or QueryStats()
+        response.headers.add("Server-Timing", stats.server_timing())
+        for statement, count in stats.repeated(threshold).items():
+            app.logger.warning(
+                "Possible N+1 query: %s %s executed %d times: %s",
+                request.method, request.path, count, statement
+            )
+        return response
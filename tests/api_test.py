@@ -1,16 +1,29 @@
 import pytest
 import copy
+import datetime
+import json
+import jwt
 import tempfile
+import threading
 import os
 from path import Path
+import re
 import sys
+from flask import url_for
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
 
 # directory reach
 directory = Path(__file__).abspath()
 
 # setting path
 sys.path.append(directory.parent.parent)
-from productsapi.db import User
+from productsapi.db import User, Product, Category, BlacklistToken, RoleType
+from productsapi.instrumentation import fingerprint
+from productsapi.api import USER_VALIDATOR, CategoryCollection, build_href
+from productsapi.cache_backends import SQLiteCache
+from productsapi.caching import cache, cache_response
+from productsapi.encoding import ENCODERS, json_dumps
 from productsapi import create_app, db
 
 @pytest.fixture
@@ -18,7 +31,8 @@ def app():
     db_fd, db_fname = tempfile.mkstemp()
     config = {
         "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
-        "TESTING": True
+        "TESTING": True,
+        "QUERY_STATS_ENABLED": True
     }
 
     app = create_app(config)
@@ -485,6 +499,13 @@ def test_add_user_full_unsuccessful_email(app):
         assert response.status_code == 400
 
 
+def test_user_validator_checks_formats():
+    user_info = {**minimal_user_info}
+    assert USER_VALIDATOR.is_valid(user_info)
+    user_info["email"] = "test42"
+    assert not USER_VALIDATOR.is_valid(user_info)
+
+
 def test_encode_auth_token(app):
     with app.test_client() as c:
         user = User(
@@ -497,6 +518,48 @@ def test_encode_auth_token(app):
         assert isinstance(auth_token, str)
 
 
+def test_logout_blacklists_token(app):
+    with app.test_client() as c:
+        auth_token = add_user(c)
+        response = c.delete('/api/users/auth/', headers={"Authorization": auth_token})
+        assert response.status_code == 200
+
+        response = c.get('/api/users/', headers={"Authorization": auth_token})
+        assert response.status_code == 401
+        assert response.get_json()["message"] == 'Token blacklisted. Please log in again.'
+
+
+def test_verified_tokens_are_cached(app):
+    with app.test_client() as c:
+        auth_token = add_user(c)
+        token_cache = app.extensions["token_cache"]
+
+        c.get('/api/users/', headers={"Authorization": auth_token})
+        misses = token_cache.misses
+        hits = token_cache.hits
+        c.get('/api/users/', headers={"Authorization": auth_token})
+        assert token_cache.misses == misses
+        assert token_cache.hits == hits + 1
+
+        c.delete('/api/users/auth/', headers={"Authorization": auth_token})
+        assert token_cache.get(auth_token.split(" ")[1]) is None
+
+
+def test_blacklist_index_prunes_expired_tokens(app):
+    expired_token = jwt.encode(
+        {"sub": "kalamies", "exp": datetime.datetime.utcnow() - datetime.timedelta(days=1)},
+        "dev", algorithm="HS256")
+    with app.app_context():
+        db.session.add(BlacklistToken(token=expired_token))
+        db.session.commit()
+        index = app.extensions["blacklist_index"]
+        assert index.contains(expired_token)
+
+        index.prune()
+        assert not index.contains(expired_token)
+        assert BlacklistToken.query.count() == 0
+
+
 def test_add_and_get_single_user_endpoint(app):
     with app.test_client() as c:
         auth_token = add_user(c)
@@ -515,8 +578,8 @@ def test_add_and_get_single_user_endpoint(app):
         local_info["products"] = []
         local_info["reviews"] = []
         local_info.pop("@controls")
-        assert_get_request(c, '/api/users/kalamies2/',
-                           local_info, 200, auth_token)
+        assert_get_item_request(c, '/api/users/kalamies2/',
+                                local_info, 200, auth_token)
 
 
 def test_add_multiple_and_get_all_users_endpoint(app):
@@ -586,7 +649,7 @@ def test_put_without_json(app):
         assert response_put.status_code == 415
 
 
-def test_modify_user_while_username_is_used_as_foreignkey(app):
+def test_rename_user_while_username_is_used_by_products(app):
     with app.test_client() as c:
         auth_token = add_user(c)
         add_product_prereqs(c)
@@ -599,7 +662,7 @@ def test_modify_user_while_username_is_used_as_foreignkey(app):
             auth_token=auth_token
         )
 
-        # Modify user while the username is used in products table
+        # Products reference their seller by id, so the seller can be renamed
         response_get = c.get('/api/users/kalamies/',
                              headers={"Authorization": auth_token})
         userinfo = response_get.get_json()
@@ -607,7 +670,13 @@ def test_modify_user_while_username_is_used_as_foreignkey(app):
 
         response_put = c.put('/api/users/kalamies/', json=userinfo,
                              headers={"Authorization": auth_token})
-        assert response_put.status_code == 409
+        assert response_put.status_code == 204
+
+        item = c.get('/api/users/products/', headers={"Authorization": auth_token}
+                     ).get_json()["items"][0]
+        assert item["user_name"] == "something_else"
+        assert item["@controls"]["item"]["href"] == \
+            "/api/users/something_else/products/test_product/"
 
 
 def test_update_user_full_successful(app):
@@ -745,9 +814,20 @@ minimal_product_info = {
             "href": "/api/users/kalamies/products/"
         },
         'item': {'href': '/api/users/kalamies/products/test_product/'},
+        'commercemeta:reviews-for': {
+            'href': '/api/users/kalamies/products/test_product/reviews/',
+            'title': 'reviews of the product'
+        },
     }
 }
 
+empty_review_summary = {
+    "count": 0,
+    "average": None,
+    "stddev": None,
+    "histogram": {str(star): 0 for star in range(1, 11)},
+}
+
 minimal_product_info_response = {
     "name": "test_product",
     "price": 5.3,
@@ -772,6 +852,10 @@ full_product_info = {
             "href": "/api/categories/test_category/products/"
         },
         'item': {'href': '/api/users/kalamies/products/test_product/'},
+        'commercemeta:reviews-for': {
+            'href': '/api/users/kalamies/products/test_product/reviews/',
+            'title': 'reviews of the product'
+        },
     }
 }
 
@@ -791,6 +875,10 @@ full_product_info_2 = {
             "href": "/api/categories/test_category/products/"
         },
         'item': {'href': '/api/users/kalamies/products/test_product2/'},
+        'commercemeta:reviews-for': {
+            'href': '/api/users/kalamies/products/test_product2/reviews/',
+            'title': 'reviews of the product'
+        },
     }
 }
 
@@ -809,6 +897,10 @@ updated_full_product_info = {
             "href": "/api/categories/test_category/products/"
         },
         'item': {'href': '/api/users/kalamies/products/test_product_updated/'},
+        'commercemeta:reviews-for': {
+            'href': '/api/users/kalamies/products/test_product_updated/reviews/',
+            'title': 'reviews of the product'
+        },
     }
 }
 
@@ -858,6 +950,51 @@ minimal_category_info = {
     }
 }
 
+# CACHE BACKENDS
+
+
+def test_sqlite_cache_evicts_least_recently_used(tmp_path):
+    cache = SQLiteCache(str(tmp_path / "cache.sqlite"), threshold=2)
+    cache.touch_interval = 0
+    cache.set("first", 1)
+    cache.set("second", {"name": "test_product"})
+    assert cache.get("first") == 1
+    cache.set("third", [1, 2])
+
+    assert cache.get("second") is None
+    assert cache.get("first") == 1
+    assert cache.get("third") == [1, 2]
+
+    assert not cache.add("first", 2)
+    assert cache.inc("counter") == 1
+    assert cache.inc("counter") == 2
+    cache.set("expired", 1, timeout=-1)
+    assert cache.get("expired") is None
+
+
+def test_sqlite_cache_is_shared_between_apps(tmp_path):
+    db_fd, db_fname = tempfile.mkstemp()
+    config = {
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "CACHE_TYPE": "productsapi.cache_backends.SQLiteCache",
+        "CACHE_SQLITE_PATH": str(tmp_path / "cache.sqlite")
+    }
+    worker_1 = create_app(config)
+    worker_2 = create_app(config)
+    with worker_1.app_context():
+        db.create_all()
+
+    c1 = worker_1.test_client()
+    c2 = worker_2.test_client()
+    auth_token = add_product_prereqs(c1)
+    assert c2.get('/api/users/products/').get_json()["items"] == []
+
+    add_model(c1, '/api/users/products/', minimal_product_info, auth_token)
+    assert len(c2.get('/api/users/products/').get_json()["items"]) == 1
+    os.close(db_fd)
+
+
 # GET ALL PRODUCTS
 
 
@@ -887,7 +1024,7 @@ def test_successful_add_product_minimal(app):
         local_info["id"] = 1
         local_info["images"] = None
         local_info["description"] = None
-        local_info["reviews"] = []
+        local_info["review_summary"] = empty_review_summary
         local_info["categories"] = []
         local_response_info = {**api_products_response_body}
         local_response_info["items"] = [local_info]
@@ -909,7 +1046,7 @@ def test_successful_add_product_full(app):
 
         local_info = {**full_product_info}
         local_info["id"] = 1
-        local_info["reviews"] = []
+        local_info["review_summary"] = empty_review_summary
         local_info["categories"] = [{"id": 1, **dummy_category_info}]
 
         local_response_info = {**api_products_response_body}
@@ -1048,7 +1185,7 @@ def test_add_and_get_single_product_endpoint(app):
         local_info.pop("user_name")
         local_info.pop("@controls")
         
-        assert_get_request(
+        assert_get_item_request(
             c, '/api/users/kalamies/products/test_product/', local_info, 200, auth_token)
 
 
@@ -1102,7 +1239,7 @@ def test_add_multiple_and_get_all_products_endpoint(app):
         local_info["id"] = 1
         local_info_2["id"] = 2
 
-        local_info["reviews"] = local_info_2["reviews"] = []
+        local_info["review_summary"] = local_info_2["review_summary"] = empty_review_summary
         local_info["categories"] = local_info_2["categories"] = [
             {"id": 1, **dummy_category_info}]
         local_response_info = {**api_products_response_body}
@@ -1111,6 +1248,802 @@ def test_add_multiple_and_get_all_products_endpoint(app):
                            local_response_info, 200, auth_token)
 
 
+def test_get_products_paginated(app):
+    with app.test_client() as c:
+        auth_token = add_product_prereqs(c)
+        for i in range(3):
+            product_info = copy.deepcopy(minimal_product_info)
+            product_info["name"] = "paged_product" + str(i)
+            add_model(c, '/api/users/products/', product_info, auth_token)
+
+        response = c.get('/api/users/products/?limit=2',
+                         headers={"Authorization": auth_token})
+        assert response.status_code == 200
+        body = response.get_json()
+        assert [item["id"] for item in body["items"]] == [1, 2]
+        assert body["@controls"]["next"]["href"] == "/api/users/products/?after=2&limit=2"
+        assert "prev" not in body["@controls"]
+
+        response = c.get(body["@controls"]["next"]["href"],
+                         headers={"Authorization": auth_token})
+        body = response.get_json()
+        assert [item["id"] for item in body["items"]] == [3]
+        assert "next" not in body["@controls"]
+        assert body["@controls"]["prev"]["href"] == "/api/users/products/?limit=2"
+
+        response = c.get('/api/users/products/?limit=0',
+                         headers={"Authorization": auth_token})
+        assert response.status_code == 400
+        response = c.get('/api/users/products/?after=abc',
+                         headers={"Authorization": auth_token})
+        assert response.status_code == 400
+
+
+def test_get_products_filtered_and_sorted(app):
+    with app.test_client() as c:
+        auth_token = add_product_prereqs(c)
+        headers = {"Authorization": auth_token}
+        for i, price in enumerate([5, 1, 7, 3, 9, 5]):
+            product_info = copy.deepcopy(minimal_product_info)
+            product_info["name"] = "sorted_product" + str(i)
+            product_info["price"] = price
+            add_model(c, '/api/users/products/', product_info, auth_token)
+        add_model(c, '/api/users/reviews/', {**full_review_info, "product_name": "sorted_product3"}, auth_token)
+
+        url = '/api/users/products/?min_price=2&max_price=8&sort=price&order=desc&limit=2'
+        pages = []
+        while url:
+            body = c.get(url, headers=headers).get_json()
+            pages.append([(item["price"], item["id"]) for item in body["items"]])
+            url = body["@controls"].get("next", {}).get("href")
+        assert pages == [[(7, 3), (5, 6)], [(5, 1), (3, 4)]]
+        assert body["@controls"]["prev"]["href"] == \
+            "/api/users/products/?limit=2&max_price=8&min_price=2&order=desc&sort=price"
+        # Links do not depend on the order the parameters were requested in
+        body = c.get('/api/users/products/?limit=2&order=desc&sort=price&max_price=8&min_price=2',
+                     headers=headers).get_json()
+        assert body["@controls"]["next"]["href"] == \
+            "/api/users/products/?after=6&limit=2&max_price=8&min_price=2&order=desc&sort=price"
+
+        items = c.get('/api/users/products/?sort=rating&order=desc&limit=1',
+                      headers=headers).get_json()["items"]
+        assert items[0]["name"] == "sorted_product3"
+        items = c.get('/api/users/kalamies/products/?max_price=4&sort=name',
+                      headers=headers).get_json()["items"]
+        assert [item["name"] for item in items] == ["sorted_product1", "sorted_product3"]
+
+        # Sorted and filtered pages are rebuilt on writes instead of patched
+        url = '/api/users/products/?sort=price&order=desc'
+        assert c.get(url, headers=headers).get_json()["items"][0]["price"] == 9
+        product_info = copy.deepcopy(minimal_product_info)
+        product_info["name"] = "priciest_product"
+        product_info["price"] = 50
+        add_model(c, '/api/users/products/', product_info, auth_token)
+        assert c.get(url, headers=headers).get_json()["items"][0]["name"] == "priciest_product"
+
+        for url in ['/api/users/products/?sort=stock', '/api/users/products/?order=up',
+                    '/api/users/products/?min_price=cheap']:
+            assert c.get(url, headers=headers).status_code == 400
+
+
+def test_sub_collection_products_are_paginated(app):
+    with app.test_client() as c:
+        auth_token = add_product_prereqs(c)
+        headers = {"Authorization": auth_token}
+        for i, price in enumerate([5, 1, 7, 3, 9, 5]):
+            product_info = copy.deepcopy(minimal_product_info)
+            product_info["name"] = "paged_product" + str(i)
+            product_info["price"] = price
+            product_info["categories"] = ["test_category"]
+            add_model(c, '/api/users/products/', product_info, auth_token)
+
+        for collection in ['/api/users/kalamies/products/', '/api/categories/test_category/products/']:
+            url = collection + '?min_price=2&sort=price&order=desc&limit=2'
+            pages = []
+            while url:
+                body = c.get(url, headers=headers).get_json()
+                pages.append([(item["price"], item["id"]) for item in body["items"]])
+                url = body["@controls"].get("next", {}).get("href")
+            assert pages == [[(9, 5), (7, 3)], [(5, 6), (5, 1)], [(3, 4)]]
+            assert body["@controls"]["prev"]["href"] == \
+                collection + "?after=3&limit=2&min_price=2&order=desc&sort=price"
+            assert c.get(collection + '?limit=0', headers=headers).status_code == 400
+
+
+def test_product_listings_query_count_is_constant(app):
+    listing_urls = [
+        '/api/users/products/?limit=50',
+        '/api/users/kalamies/products/',
+        '/api/categories/test_category/products/',
+    ]
+    with app.test_client() as c:
+        auth_token = add_product_prereqs(c)
+        query_counts = []
+        for i in range(4):
+            product_info = copy.deepcopy(minimal_product_info)
+            product_info["name"] = "counted_product" + str(i)
+            product_info["categories"] = ["test_category"]
+            add_model(c, '/api/users/products/', product_info, auth_token)
+            add_model(c, '/api/users/reviews/', {
+                "rating": 5,
+                "user_name": "kalamies",
+                "product_name": product_info["name"]
+            }, auth_token)
+            with app.app_context():
+                cache.clear()
+            query_counts.append([count_queries(c, url, auth_token) for url in listing_urls])
+
+        assert query_counts[0] == query_counts[-1]
+
+
+def test_query_budgets(app):
+    with app.test_client() as c:
+        auth_token = add_review_prereqs(c)
+        add_model(c, '/api/users/reviews/', full_review_info, auth_token)
+
+        assert count_queries(c, '/api/users/kalamies/reviews/test_product/', auth_token) <= 6
+        assert count_queries(c, '/api/categories/test_category/products/', auth_token) <= 3
+
+
+def test_url_converters_cache_name_keys(app):
+    with app.test_client() as c:
+        auth_token = add_product_prereqs(c)
+        headers = {"Authorization": auth_token}
+
+        c.get('/api/users/kalamies/', headers=headers)
+        assert count_queries(c, '/api/users/kalamies/', auth_token) == 0
+        c.get('/api/categories/test_category/', headers=headers)
+        assert count_queries(c, '/api/categories/test_category/', auth_token) == 0
+
+        # Unknown names are remembered until they are created
+        assert c.get('/api/users/palomies/', headers=headers).status_code == 404
+        response = c.get('/api/users/palomies/', headers=headers)
+        assert response.status_code == 404
+        assert 'desc="0 queries"' in response.headers["Server-Timing"]
+        user_info = {**dummy_user_info, "name": "palomies", "email": "palo@example.com"}
+        user_info.pop("@controls")
+        add_model(c, '/api/users/', user_info)
+        assert c.get('/api/users/palomies/', headers=headers).status_code == 200
+
+        # Renamed categories are found by their new name only
+        assert c.put('/api/categories/test_category/', json={"name": "renamed"},
+                     headers=headers).status_code == 204
+        assert c.get('/api/categories/test_category/', headers=headers).status_code == 404
+        assert c.get('/api/categories/renamed/', headers=headers).get_json()["name"] == "renamed"
+
+        # Rows deleted by another worker are not found once their cached
+        # responses are gone
+        with app.app_context():
+            db.session.execute(db.text("DELETE FROM user WHERE name = 'palomies'"))
+            db.session.commit()
+            cache.clear()
+        assert c.get('/api/users/palomies/', headers=headers).status_code == 404
+        assert c.get('/api/users/kalamies/', headers=headers).status_code == 200
+
+
+def test_control_hrefs_match_url_for(app):
+    name = "a b/ä%?#&+"
+    cases = [
+        ("users", {}),
+        ("user", {"user": name}),
+        ("product", {"username": name, "product": name}),
+        ("reviews_for", {"username": name, "product": name}),
+        ("products_by_category", {"category": name}),
+        ("category", {"category": name}),
+    ]
+    for base_url in ["http://localhost/", "http://localhost/prefix/"]:
+        with app.test_request_context("/", base_url=base_url):
+            for endpoint, values in cases:
+                assert build_href(endpoint, **values) == url_for(endpoint, **values)
+
+    with app.test_client() as c:
+        auth_token = add_user(c)
+        controls = c.get('/api/users/kalamies/', headers={"Authorization": auth_token}
+                         ).get_json()["@controls"]
+        assert controls["commercemeta:reviews-by"]["href"] == "/api/users/kalamies/reviews/"
+        assert controls["commercemeta:products-by"]["href"] == "/api/users/kalamies/products/"
+
+
+def test_controls_reference_schemas_by_url(tmp_path):
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmp_path / "schemas.db"),
+        "SCHEMA_MODE": "url",
+    })
+    with app.app_context():
+        db.create_all()
+    with app.test_client() as c:
+        auth_token = add_product_prereqs(c)
+        headers = {"Authorization": auth_token}
+
+        add_control = c.get('/api/users/products/').get_json()["@controls"]["commercemeta:add-product"]
+        assert "schema" not in add_control
+        assert add_control["schemaUrl"] == "/schemas/product/"
+        edit_control = c.get('/api/users/kalamies/', headers=headers).get_json()["@controls"]["edit"]
+        assert edit_control["schemaUrl"] == "/schemas/user/"
+        assert edit_control["href"] == "/api/users/kalamies/"
+
+        response = c.get(add_control["schemaUrl"])
+        assert response.mimetype == "application/schema+json"
+        assert response.get_json() == Product.json_schema()
+        assert response.cache_control.public
+        assert response.cache_control.max_age == 24 * 3600
+        assert c.get(add_control["schemaUrl"], headers={
+            "If-None-Match": response.headers["ETag"]}).status_code == 304
+        assert c.get('/schemas/nothing/').status_code == 404
+
+
+def test_encoders_produce_the_same_bodies():
+    document = {
+        "name": "Käyttäjä \u2603",
+        "role": RoleType.Admin,
+        "created": datetime.datetime(2023, 3, 1, 12, 30, 5, 123456),
+        "expires": datetime.datetime(2023, 3, 1, tzinfo=datetime.timezone.utc),
+        "day": datetime.date(2023, 3, 1),
+        "histogram": {1: 0, 10: 2},
+        "items": [1.5, None, True],
+    }
+    expected = json_dumps(document)
+    assert json.loads(expected)["role"] == RoleType.Admin.value
+    assert json.loads(expected)["created"] == "2023-03-01T12:30:05.123456"
+    for name, encoder in ENCODERS.items():
+        assert encoder(document) == expected, name
+    with pytest.raises(TypeError):
+        json_dumps({"value": object()})
+
+
+def test_stdlib_encoder_serves_responses(tmp_path):
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmp_path / "encoder.db"),
+        "JSON_ENCODER": "json",
+    })
+    with app.app_context():
+        db.create_all()
+    with app.test_client() as c:
+        auth_token = add_product_prereqs(c)
+        add_model(c, '/api/users/products/', full_product_info, auth_token)
+        response = c.get('/api/users/kalamies/', headers={"Authorization": auth_token})
+        assert isinstance(response.get_json()["role"], str)
+        response = c.get('/api/users/products/')
+        assert response.mimetype == "application/vnd.mason+json"
+        assert response.get_json()["items"][0]["name"] == full_product_info["name"]
+
+
+def test_cached_responses_are_served_as_is(app):
+    with app.test_client() as c:
+        auth_token = add_product_prereqs(c)
+        add_model(c, '/api/users/products/', full_product_info, auth_token)
+
+        for url in ['/api/users/products/?limit=10', '/api/users/kalamies/products/test_product/']:
+            response_miss = c.get(url, headers={"Authorization": auth_token})
+            response_hit = c.get(url, headers={"Authorization": auth_token})
+            assert response_hit.data == response_miss.data
+            assert response_hit.headers["ETag"] == response_miss.headers["ETag"]
+            assert response_hit.mimetype == "application/vnd.mason+json"
+            assert "@controls" in response_hit.get_json()
+
+        assert count_queries(c, '/api/users/products/?limit=10', auth_token) == 0
+
+
+def test_unknown_query_parameters_share_the_cached_representation(app):
+    with app.test_client() as c:
+        auth_token = add_product_prereqs(c)
+        add_model(c, '/api/users/products/', full_product_info, auth_token)
+
+        default = c.get('/api/users/products/?limit=1')
+        for index in range(40):
+            response = c.get(f'/api/users/products/?limit=1&x={index}')
+            assert response.headers["ETag"] == default.headers["ETag"]
+            assert "x=" not in response.get_json()["@controls"]["self"]["href"]
+        assert count_queries(c, '/api/users/products/?limit=1') == 0
+        assert count_queries(c, '/api/users/products/?fields=price,name&limit=1') > 0
+        assert count_queries(c, '/api/users/products/?limit=1&fields=name,price') == 0
+        with app.app_context():
+            assert len(cache.get("products_all")) == 2
+
+
+def test_responses_built_before_a_write_are_not_cached(app):
+    with app.test_client() as c:
+        auth_token = add_user(c)
+        with app.test_request_context('/api/categories/'):
+            response, tags = CategoryCollection().render()
+            writer = threading.Thread(target=add_model, args=(
+                app.test_client(), '/api/categories/', dummy_category_info, auth_token))
+            writer.start()
+            writer.join()
+            response = cache_response("categories_all", response, tags)
+            assert response.get_json()["items"] == []
+            assert response.get_etag() == (None, None)
+
+        items = c.get('/api/categories/').get_json()["items"]
+        assert [item["name"] for item in items] == [dummy_category_info["name"]]
+
+
+def test_writes_invalidate_dependent_cache_entries(app):
+    with app.test_client() as c:
+        auth_token = add_review_prereqs(c)
+        headers = {"Authorization": auth_token}
+        product_url = '/api/users/kalamies/products/test_product/'
+
+        assert c.get(product_url, headers=headers).get_json()["reviews"] == []
+        assert c.get('/api/users/kalamies/', headers=headers).get_json()["reviews"] == []
+        assert c.get('/api/users/products/', headers=headers).get_json()["items"][0]["review_summary"]["count"] == 0
+        c.get('/api/categories/', headers=headers)
+
+        add_model(c, '/api/users/reviews/', full_review_info, auth_token)
+
+        assert len(c.get(product_url, headers=headers).get_json()["reviews"]) == 1
+        assert len(c.get('/api/users/kalamies/', headers=headers).get_json()["reviews"]) == 1
+        assert c.get('/api/users/products/', headers=headers).get_json()["items"][0]["review_summary"]["count"] == 1
+        # Entries not built from the review are kept
+        assert count_queries(c, '/api/categories/', auth_token) == 0
+
+        user_info = {**dummy_user_info, "email": "new@example.com"}
+        user_info.pop("@controls")
+        assert c.put('/api/users/kalamies/', json=user_info, headers=headers).status_code == 204
+        reviews = c.get(product_url, headers=headers).get_json()["reviews"]
+        assert reviews[0]["user"]["email"] == "new@example.com"
+
+
+def test_writes_invalidate_entries_after_the_tag_index_is_evicted(app):
+    with app.test_client() as c:
+        auth_token = add_review_prereqs(c)
+        headers = {"Authorization": auth_token}
+        product_url = '/api/users/kalamies/products/test_product/'
+
+        assert c.get(product_url, headers=headers).get_json()["reviews"] == []
+        assert count_queries(c, product_url, auth_token) == 0
+        with app.app_context():
+            evicted = [key for key in cache.cache._cache if key.startswith("tag:")]
+            assert evicted
+            cache.delete_many(*evicted)
+
+        add_model(c, '/api/users/reviews/', full_review_info, auth_token)
+
+        assert len(c.get(product_url, headers=headers).get_json()["reviews"]) == 1
+        assert count_queries(c, product_url, auth_token) == 0
+
+
+def test_sub_collections_are_cached_per_scope(app):
+    sub_collection_urls = [
+        '/api/users/kalamies/products/',
+        '/api/categories/test_category/products/',
+        '/api/users/kalamies/reviews/',
+    ]
+    with app.test_client() as c:
+        auth_token = add_review_prereqs(c)
+        product_info = copy.deepcopy(full_product_info)
+        product_info["name"] = "categorized_product"
+        product_info["categories"] = ["test_category"]
+        add_model(c, '/api/users/products/', product_info, auth_token)
+        headers = {"Authorization": auth_token}
+
+        for url in sub_collection_urls:
+            assert c.get(url, headers=headers).status_code == 200
+            assert count_queries(c, url, auth_token) == 0
+        # The global collection is not served the filtered lists
+        assert len(c.get('/api/users/products/', headers=headers).get_json()["items"]) == 2
+
+        add_model(c, '/api/users/reviews/', full_review_info, auth_token)
+        reviews = c.get('/api/users/kalamies/reviews/', headers=headers).get_json()["items"]
+        assert reviews[0]["@controls"]["customer"]["href"] == "/api/users/kalamies/"
+        products = c.get('/api/users/kalamies/products/', headers=headers).get_json()["items"]
+        assert products[0]["review_summary"]["count"] == 1
+        assert c.get('/api/users/nobody/reviews/', headers=headers).status_code == 404
+
+
+def test_product_listings_summarize_reviews(app):
+    with app.test_client() as c:
+        auth_token = add_review_prereqs(c)
+        headers = {"Authorization": auth_token}
+        add_model(c, '/api/users/reviews/', full_review_info, auth_token)
+        user_info = {**dummy_user_info, "name": "palomies", "email": "palo@example.com"}
+        user_info.pop("@controls")
+        add_model(c, '/api/users/', user_info, auth_token)
+        add_model(c, '/api/users/reviews/', {**full_review_info_2, "user_name": "palomies"}, auth_token)
+
+        for url in ['/api/users/products/', '/api/users/kalamies/products/']:
+            item = c.get(url, headers=headers).get_json()["items"][0]
+            assert "reviews" not in item
+            assert item["review_summary"]["count"] == 2
+            assert item["review_summary"]["average"] == 5.5
+            assert item["review_summary"]["histogram"]["2"] == 1
+            assert item["review_summary"]["histogram"]["8"] == 1
+
+        reviews_url = item["@controls"]["commercemeta:reviews-for"]["href"]
+        reviews = c.get(reviews_url, headers=headers).get_json()["items"]
+        assert [review["rating"] for review in reviews] == [2.5, 8.5]
+        assert c.get('/api/users/kalamies/products/nothing/reviews/',
+                     headers=headers).status_code == 404
+
+
+def test_rating_aggregates_are_maintained_and_rebuilt(app):
+    with app.test_client() as c:
+        auth_token = add_review_prereqs(c)
+        headers = {"Authorization": auth_token}
+        review_url = '/api/users/kalamies/reviews/test_product/'
+        add_model(c, '/api/users/reviews/', full_review_info, auth_token)
+        assert c.put(review_url, json={**full_review_info, "rating": 4},
+                     headers=headers).status_code == 204
+
+        with app.app_context():
+            product = Product.query.filter_by(name="test_product").first()
+            assert product.rating_summary()["count"] == 1
+            assert product.rating_summary()["average"] == 4
+            assert product.rating_summary()["stddev"] == 0
+            assert product.rating_summary()["histogram"]["4"] == 1
+            assert product.rating_summary()["histogram"]["2"] == 0
+            product.review_count = 7
+            db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=["rebuild-ratings"])
+        assert result.exit_code == 0
+        with app.app_context():
+            product = Product.query.filter_by(name="test_product").first()
+            assert product.rating_summary()["count"] == 1
+            assert product.rating_sum_squares == 16
+
+        assert c.delete(review_url, headers=headers).status_code == 204
+        item = c.get('/api/users/products/', headers=headers).get_json()["items"][0]
+        assert item["review_summary"] == empty_review_summary
+
+
+def test_writes_change_the_etags_of_their_collections(app):
+    collections = {
+        "users": '/api/users/',
+        "products": '/api/users/products/',
+        "reviews": '/api/users/reviews/',
+        "categories": '/api/categories/',
+    }
+    user_info = {**dummy_user_info, "name": "palomies", "email": "palo@example.com"}
+    user_info.pop("@controls")
+    category_info = {"name": "second_category", "image": "https://example.com/"}
+    product_info = {**minimal_product_info, "name": "second_product"}
+    review_url = '/api/users/kalamies/reviews/test_product/'
+    writes = [
+        ("users", "post", '/api/users/', user_info),
+        ("users", "put", '/api/users/palomies/', {**user_info, "email": "new@example.com"}),
+        ("categories", "post", '/api/categories/', category_info),
+        ("categories", "put", '/api/categories/second_category/',
+         {**category_info, "image": "https://example.com/new/"}),
+        ("products", "post", '/api/users/products/', product_info),
+        ("products", "put", '/api/users/kalamies/products/second_product/',
+         {**product_info, "price": 99}),
+        ("reviews", "post", '/api/users/reviews/', full_review_info),
+        ("reviews", "put", review_url, {**full_review_info, "rating": 9}),
+        ("reviews", "delete", review_url, None),
+        ("products", "delete", '/api/users/kalamies/products/second_product/', None),
+        ("categories", "delete", '/api/categories/second_category/', None),
+        ("users", "delete", '/api/users/palomies/', None),
+    ]
+    with app.test_client() as c:
+        auth_token = add_review_prereqs(c)
+        headers = {"Authorization": auth_token}
+        for collection, method, url, body in writes:
+            collection_url = collections[collection]
+            etag = c.get(collection_url, headers=headers).headers["ETag"]
+            response = getattr(c, method)(url, json=body, headers=headers)
+            assert response.status_code in (201, 204), (method, url)
+            response = c.get(collection_url, headers={**headers, "If-None-Match": etag})
+            assert response.status_code == 200, (method, url)
+            assert response.headers["ETag"] != etag, (method, url)
+
+
+def test_patched_sparse_collections_match_rebuilt_ones(app):
+    with app.test_client() as c:
+        auth_token = add_user(c)
+        headers = {"Authorization": auth_token}
+        user_info = {**dummy_user_info, "name": "zed", "email": "zed@example.com"}
+        user_info.pop("@controls")
+        add_model(c, '/api/users/', user_info)
+        add_model(c, '/api/categories/', {**dummy_category_info, "name": "zed_category"}, auth_token)
+
+        urls = ['/api/users/?fields=name', '/api/categories/?fields=name']
+        for url in urls:
+            c.get(url, headers=headers)
+        add_model(c, '/api/users/', {**user_info, "name": "amy", "email": "amy@example.com"})
+        add_model(c, '/api/categories/', {**dummy_category_info, "name": "amy_category"}, auth_token)
+
+        patched = [c.get(url, headers=headers).get_json()["items"] for url in urls]
+        with app.app_context():
+            cache.clear()
+        rebuilt = [c.get(url, headers=headers).get_json()["items"] for url in urls]
+        assert patched == rebuilt
+        assert [item["name"] for item in rebuilt[0]] == ["kalamies", "zed", "amy"]
+
+
+def test_sparse_fieldsets(app):
+    with app.test_client() as c:
+        auth_token = add_review_prereqs(c)
+        headers = {"Authorization": auth_token}
+        url = '/api/users/products/?fields=name,price'
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        with app.app_context():
+            event.listen(db.engine, "before_cursor_execute", record)
+        items = c.get(url, headers=headers).get_json()["items"]
+        assert set(items[0]) == {"id", "name", "price", "@controls"}
+        assert "item" in items[0]["@controls"]
+        assert not any("product.description" in statement for statement in statements)
+
+        # Items patched into a cached sparse page keep its fields
+        product_info = copy.deepcopy(full_product_info)
+        product_info["name"] = "another_product"
+        add_model(c, '/api/users/products/', product_info, auth_token)
+        items = c.get(url, headers=headers).get_json()["items"]
+        assert [set(item) for item in items] == [{"id", "name", "price", "@controls"}] * 2
+        page = c.get('/api/users/products/?limit=1&fields=name', headers=headers).get_json()
+        assert "fields=name" in page["@controls"]["next"]["href"]
+
+        user = c.get('/api/users/kalamies/?fields=email', headers=headers).get_json()
+        assert {key for key in user if not key.startswith("@")} == {"email"}
+        assert c.get('/api/users/products/?fields=bogus', headers=headers).status_code == 400
+
+
+def test_concurrent_misses_are_rebuilt_once(app):
+    with app.test_client() as c:
+        auth_token = add_review_prereqs(c)
+    flights = app.extensions["single_flight"]
+    responses = []
+
+    def get_products():
+        with app.test_client() as client:
+            responses.append(client.get('/api/users/products/'))
+
+    threads = [threading.Thread(target=get_products) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [response.status_code for response in responses] == [200] * 8
+    assert len({response.data for response in responses}) == 1
+    assert flights.rebuilds == 1
+    assert flights.timeouts == 0
+
+
+def test_single_flight_waits_for_the_rebuild(app):
+    flights = app.extensions["single_flight"]
+    waited = []
+
+    def join_rebuild():
+        with app.test_request_context('/api/users/products/'):
+            waited.append(flights.begin("products_all"))
+
+    with app.test_request_context('/api/users/products/'):
+        assert flights.begin("products_all") is False
+        thread = threading.Thread(target=join_rebuild)
+        thread.start()
+        thread.join(0.1)
+        assert thread.is_alive()
+        flights.end("products_all")
+        thread.join()
+
+    assert waited == [True]
+
+
+def test_collections_are_patched_on_writes(app):
+    collection_urls = [
+        '/api/users/',
+        '/api/users/products/?limit=10',
+        '/api/users/reviews/',
+        '/api/categories/',
+    ]
+    with app.test_client() as c:
+        auth_token = add_review_prereqs(c)
+        headers = {"Authorization": auth_token}
+        for url in collection_urls:
+            c.get(url, headers=headers)
+
+        add_model(c, '/api/users/', {"name": "other_user", "email": "other@test.com", "password": "123456"})
+        add_model(c, '/api/users/reviews/', full_review_info, auth_token)
+        add_model(c, '/api/users/products/', {
+            "name": "categorized_product", "price": 3, "user_name": "kalamies", "categories": ["test_category"]
+        }, auth_token)
+        c.put('/api/users/kalamies/reviews/test_product/', json={**full_review_info, "rating": 4},
+              headers=headers)
+        c.put('/api/categories/test_category/', json={"name": "test_category", "image": "https://example.com/"},
+              headers=headers)
+
+        patched = []
+        for url in collection_urls:
+            assert count_queries(c, url, auth_token) == 0
+            patched.append(c.get(url, headers=headers).get_json())
+        with app.app_context():
+            cache.clear()
+        assert [c.get(url, headers=headers).get_json() for url in collection_urls] == patched
+
+        assert c.delete('/api/users/kalamies/reviews/test_product/', headers=headers).status_code == 204
+        assert c.delete('/api/users/kalamies/products/categorized_product/', headers=headers).status_code == 204
+        patched = [c.get(url, headers=headers).get_json() for url in collection_urls]
+        with app.app_context():
+            cache.clear()
+        assert [c.get(url, headers=headers).get_json() for url in collection_urls] == patched
+
+
+def test_conditional_get_is_answered_from_the_cache(app):
+    with app.test_client() as c:
+        auth_token = add_review_prereqs(c)
+        headers = {"Authorization": auth_token}
+        for url in ['/api/users/products/', '/api/users/kalamies/products/test_product/',
+                    '/api/users/reviews/']:
+            etag = c.get(url, headers=headers).headers["ETag"]
+            response = c.get(url, headers={**headers, "If-None-Match": etag})
+            assert response.status_code == 304
+            assert response.data == b""
+            assert response.headers["Server-Timing"].startswith('db;desc="0 queries"')
+
+        etag = c.get('/api/users/products/').headers["ETag"]
+        add_model(c, '/api/users/reviews/', full_review_info, auth_token)
+        response = c.get('/api/users/products/', headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        assert response.get_json()["items"][0]["review_summary"]["count"] == 1
+
+
+def test_stale_collections_are_revalidated_in_background(app):
+    app.config["CACHE_STALE_WHILE_REVALIDATE"] = True
+    revalidator = app.extensions["revalidator"]
+    with app.test_client() as c:
+        auth_token = add_review_prereqs(c)
+        headers = {"Authorization": auth_token}
+        assert "next" not in c.get('/api/users/products/?limit=1').get_json()["@controls"]
+
+        # The new product does not fit on the full page, so the page cannot be
+        # patched and the stale page is served while it is rebuilt
+        add_model(c, '/api/users/products/', {**minimal_product_info, "name": "product_2"}, auth_token)
+        assert "next" not in c.get('/api/users/products/?limit=1').get_json()["@controls"]
+        revalidator.queue.join()
+        assert "next" in c.get('/api/users/products/?limit=1').get_json()["@controls"]
+        assert revalidator.revalidations == 1
+
+        # Items are not revalidated, a stale item is rebuilt right away
+        c.get('/api/categories/test_category/', headers=headers)
+        c.put('/api/categories/test_category/', json={"name": "test_category", "image": "https://example.com/"},
+              headers=headers)
+        category = c.get('/api/categories/test_category/', headers=headers).get_json()
+        assert category["image"] == "https://example.com/"
+
+        # Past the maximum staleness the page is rebuilt right away too
+        app.config["CACHE_MAX_STALENESS"] = -1
+        assert "next" not in c.get('/api/users/products/?limit=2').get_json()["@controls"]
+        add_model(c, '/api/users/products/', {**minimal_product_info, "name": "product_3"}, auth_token)
+        assert "next" in c.get('/api/users/products/?limit=2').get_json()["@controls"]
+
+
+def test_sqlite_profile_pragmas(app, tmp_path):
+    with app.app_context():
+        assert db.session.execute(db.text("PRAGMA journal_mode")).scalar() == "wal"
+        assert db.session.execute(db.text("PRAGMA synchronous")).scalar() == 1
+        assert db.session.execute(db.text("PRAGMA busy_timeout")).scalar() == 5000
+        assert db.session.execute(db.text("PRAGMA temp_store")).scalar() == 2
+
+    default_app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmp_path / "default.db"),
+        "SQLITE_PROFILE": "default",
+        "SQLITE_PRAGMAS": {"cache_size": -1024},
+    })
+    with default_app.app_context():
+        assert db.session.execute(db.text("PRAGMA journal_mode")).scalar() == "delete"
+        assert db.session.execute(db.text("PRAGMA cache_size")).scalar() == -1024
+
+
+def test_upgrade_db_creates_foreign_key_indexes(app):
+    with app.test_client() as c:
+        auth_token = add_review_prereqs(c)
+        add_model(c, '/api/users/reviews/', full_review_info, auth_token)
+
+    indexes = ["ix_review_user_id_product_id", "ix_review_product_id",
+               "ix_product_user_id", "ix_product_categories_category_id_product_id"]
+    with app.app_context():
+        for index in indexes:
+            db.session.execute(db.text("DROP INDEX " + index))
+        db.session.execute(db.text(
+            "INSERT INTO review (rating, user_id, product_id) VALUES (3, 1, 1)"))
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=["upgrade-db"])
+    assert result.exit_code != 0
+    assert "ix_review_user_id_product_id" in result.output
+
+    with app.app_context():
+        db.session.execute(db.text("DELETE FROM review WHERE rating = 3"))
+        db.session.commit()
+    result = app.test_cli_runner().invoke(args=["upgrade-db"])
+    assert result.exit_code == 0
+    with app.app_context():
+        existing = {index["name"] for table in ["review", "product", "product_categories"]
+                    for index in db.inspect(db.engine).get_indexes(table)}
+        assert set(indexes) <= existing
+        plan = db.session.execute(db.text(
+            "EXPLAIN QUERY PLAN SELECT * FROM review WHERE product_id = 1")).all()
+        assert "ix_review_product_id" in str(plan)
+
+
+def test_upgrade_db_moves_name_keys_to_integer_keys(tmp_path):
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmp_path / "old.db")})
+    with app.app_context():
+        # The tables as they were when products and reviews referenced names
+        User.__table__.create(db.engine)
+        Category.__table__.create(db.engine)
+        for statement in [
+            "CREATE TABLE product (id INTEGER PRIMARY KEY, name VARCHAR(256) NOT NULL UNIQUE, "
+            "price FLOAT NOT NULL, description VARCHAR(65535), images VARCHAR(65535), "
+            "user_name VARCHAR(256) NOT NULL REFERENCES user (name))",
+            "CREATE TABLE review (id INTEGER PRIMARY KEY, description VARCHAR(65535), "
+            "rating FLOAT NOT NULL, user_name VARCHAR(256) NOT NULL REFERENCES user (name), "
+            "product_name VARCHAR(256) NOT NULL REFERENCES product (name))",
+            "CREATE TABLE product_categories (product_id INTEGER REFERENCES product (id), "
+            "category_id INTEGER REFERENCES category (id), PRIMARY KEY (product_id, category_id))",
+            "INSERT INTO user (id, name, password, email, role) "
+            "VALUES (1, 'seller', 'secret', 'seller@example.com', 'Seller'), "
+            "(2, 'buyer', 'secret', 'buyer@example.com', 'Customer')",
+            "INSERT INTO category (id, name) VALUES (1, 'books')",
+            "INSERT INTO product (id, name, price, user_name) VALUES (1, 'book', 10, 'seller')",
+            "INSERT INTO product_categories VALUES (1, 1)",
+            "INSERT INTO review (id, rating, user_name, product_name) "
+            "VALUES (1, 4, 'buyer', 'book'), (2, 6, 'seller', 'book')",
+        ]:
+            db.session.execute(db.text(statement))
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=["upgrade-db"])
+    assert result.exit_code == 0, result.output
+    assert "dropped 0 rows" in result.output
+
+    with app.app_context():
+        product = Product.query.one()
+        assert (product.user_id, product.user_name, product.rating_average) == (1, "seller", 5)
+        assert [category.name for category in product.categories] == ["books"]
+        assert [(review.user_id, review.product_id, review.product_name)
+                for review in product.reviews] == [(2, 1, "book"), (1, 1, "book")]
+        assert db.session.execute(db.text("PRAGMA foreign_key_check")).all() == []
+
+
+def test_rows_deleted_by_other_workers_are_not_found(tmp_path):
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmp_path / "deleted.db"),
+        "PROPAGATE_EXCEPTIONS": False,
+    })
+    with app.app_context():
+        db.create_all()
+    with app.test_client() as c:
+        headers = {"Authorization": add_user(c)}
+        user_info = {**dummy_user_info, "name": "palomies", "email": "palo@example.com"}
+        user_info.pop("@controls")
+        add_model(c, '/api/users/', user_info)
+        assert c.get('/api/users/palomies/', headers=headers).status_code == 200
+
+        # Another worker deletes the user, its name stays cached here
+        with app.app_context():
+            db.session.execute(db.text("DELETE FROM user WHERE name = 'palomies'"))
+            db.session.commit()
+            cache.clear()
+
+        for _ in range(2):
+            response = c.get('/api/users/palomies/', headers=headers)
+            assert response.status_code == 404
+        with app.app_context():
+            assert app.extensions["name_keys"].get(User, "palomies") is None
+
+
+def test_query_fingerprint():
+    assert fingerprint("SELECT * FROM product\n WHERE product.id IN (?, ?, ?)") == \
+        fingerprint("SELECT * FROM product WHERE product.id IN (?, ?)")
+    assert fingerprint("SELECT * FROM user WHERE name = 'kalamies' LIMIT 10") == \
+        "SELECT * FROM user WHERE name = ? LIMIT ?"
+
+
+def test_query_stats_keep_nothing_on_connections_of_failed_statements(app):
+    with app.app_context():
+        with db.engine.connect() as conn:
+            with pytest.raises(OperationalError):
+                conn.exec_driver_sql("SELECT * FROM no_such_table")
+            assert conn.info == {}
+            assert conn.exec_driver_sql("SELECT 1").scalar() == 1
+
+
 def test_unsuccessful_add_multiple_products_same_name(app):
     with app.test_client() as c:
         auth_token = add_user(c)
@@ -1163,7 +2096,7 @@ def test_update_product_full_successful(app):
 
         updated_local_info = {**updated_full_product_info}
         updated_local_info["id"] = 1
-        updated_local_info["reviews"] = []
+        updated_local_info["review_summary"] = empty_review_summary
         updated_local_info["user_name"] = dummy_user_info["name"]
         updated_local_info["categories"] = [{"id": 1, **dummy_category_info}]
         local_response_info = {**api_products_response_body}
@@ -1191,7 +2124,7 @@ def test_update_product_foreignkey_fields(app):
     with app.test_client() as c:
         auth_token = add_review_prereqs(c)
         # Post a review of a product
-        # Then try to change product name (used as fkey in review)
+        # Then change the product name, which the review carries
 
         response_post = assert_post_request(
             client=c,
@@ -1205,12 +2138,20 @@ def test_update_product_foreignkey_fields(app):
         modified_prod['name'] = 'new_name_for_prod'
         prod_loc = '/api/users/kalamies/products/test_product/'
 
+        # The cached listing of the reviews is invalidated by the rename
+        c.get('/api/users/reviews/', headers={"Authorization": auth_token})
         response_put = c.put(
             prod_loc,
             json=modified_prod,
             headers={"Authorization": auth_token}
         )
-        assert response_put.status_code == 409
+        assert response_put.status_code == 204
+
+        review = c.get('/api/users/reviews/', headers={"Authorization": auth_token}
+                       ).get_json()["items"][0]
+        assert review["product_name"] == "new_name_for_prod"
+        assert review["@controls"]["item"]["href"] == \
+            "/api/users/kalamies/reviews/new_name_for_prod/"
 
 # DELETE PRODUCT
 
@@ -1490,11 +2431,11 @@ def test_add_review_minimal_ratings(app):
             auth_token=auth_token
         )
 
-        assert_post_request(
+        # A user reviews a product only once
+        assert_failed_post_request(
             client=c,
             url='/api/users/reviews/',
-            expected_location_header="/api/users/kalamies/reviews/test_product/",
-            expected_response_status=201,
+            expected_response_status=409,
             json_body=minimal_review_info_highest_threshold,
             auth_token=auth_token
         )
@@ -1561,7 +2502,7 @@ def test_add_and_get_single_review_endpoint(app):
         local_info.pop("product_name")
         local_info.pop("@controls")
 
-        assert_get_request(
+        assert_get_item_request(
             c, '/api/users/kalamies/reviews/test_product/', local_info, 200, auth_token)
 
 
@@ -1583,12 +2524,13 @@ def test_add_multiple_and_get_all_reviews_endpoint(app):
             auth_token=auth_token
         )
 
+        add_model(c, "/api/users/products/", full_product_info_2, auth_token)
         assert_post_request(
             client=c,
             url='/api/users/reviews/',
-            expected_location_header="/api/users/kalamies/reviews/test_product/",
+            expected_location_header="/api/users/kalamies/reviews/test_product2/",
             expected_response_status=201,
-            json_body=full_review_info_2,
+            json_body={**full_review_info_2, "product_name": "test_product2"},
             auth_token=auth_token
         )
 
@@ -1596,7 +2538,11 @@ def test_add_multiple_and_get_all_reviews_endpoint(app):
         local_info["id"] = 1
 
         local_info = {**full_review_info}
-        local_info_2 = {**full_review_info_2}
+        local_info_2 = {**full_review_info_2, "product_name": "test_product2"}
+        local_info_2["@controls"] = {
+            **full_review_info_2["@controls"],
+            "item": {"href": "/api/users/kalamies/reviews/test_product2/"}
+        }
         local_info["id"] = 1
         local_info_2["id"] = 2
 
@@ -1913,7 +2859,7 @@ def test_add_and_get_single_category_endpoint(app):
         local_info.pop("product_names")
         local_info.pop("@controls")
 
-        assert_get_request(
+        assert_get_item_request(
             c, '/api/categories/test_category/', local_info, 200, auth_token)
 
 
@@ -2076,6 +3022,16 @@ def assert_get_request(client, url, expected_response_body, expected_response_st
     return response
 
 
+def assert_get_item_request(client, url, expected_item, expected_response_status, auth_token=""):
+    response = client.get(url, headers={"Authorization": auth_token})
+    json_response = response.get_json()
+    assert response.status_code == expected_response_status
+    assert json_response.pop("@controls")["self"]["href"] == url
+    json_response.pop("@namespaces")
+    assert json_response == expected_item
+    return response
+
+
 def assert_post_request(client, url, expected_location_header, expected_response_status, json_body, auth_token=""):
     response = client.post(url, json=json_body, headers={
                            "Authorization": auth_token})
@@ -2096,6 +3052,13 @@ def assert_failed_put_request(client, url, expected_response_status, json_body,
     assert response.status_code == expected_response_status
 
 
+def count_queries(client, url, auth_token=""):
+    response = client.get(url, headers={"Authorization": auth_token})
+    assert response.status_code == 200
+    server_timing = response.headers["Server-Timing"]
+    return int(re.search(r'db;desc="(\d+) queries"', server_timing).group(1))
+
+
 def add_model(client, url, json_body, auth_token=""):
     client.post(url, json=json_body, headers={"Authorization": auth_token})
 